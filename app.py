@@ -1,16 +1,22 @@
 import os
 import re
 import logging
-import copy
 
 # import plotly.express as px
 import streamlit as st
 
-from pystrava.utils import get_first_time_token, refresh_access_token_if_expired  # noqa: E501
-from pystrava.segments import sort_segments_from_activity, format_segments_table  # noqa: E501
-from pystrava.transformations import get_segment_coordinates, get_activity_coordinates  # noqa: E501
+from pystrava.utils import TokenManager
+from pystrava.activities import get_activity, get_athlete
+from pystrava.ratelimit import RateLimitExceeded
+from pystrava.streams import StreamStore, add_stream_metrics, streams_dir
+from pystrava.spatial import SegmentIndex
+from pystrava.history import EffortHistory, history_path
+from pystrava.segments import efforts_to_frame, sort_segments_from_activity, format_segments_table  # noqa: E501
+from pystrava.transformations import get_activity_coordinates
+from pystrava.prefetch import SegmentMapPrefetcher
 from pystrava.maps import create_map
-from pystrava.plots import plot_segments_insights
+from pystrava.plots import plot_insights
+from pystrava.timing import METRICS, trace
 
 
 def main():
@@ -48,18 +54,20 @@ def main():
         else:
             # TODO: Check if activity id is valid (trying to pull data
             # from the activity id)
-            try:
-                # Refresh tokens if expired or don't have tokens yet
-                tokens = call_refresh_access_token_if_expired(tokens)
-                logger.info("Refreshing tokens if necessary")
-            except NameError:
-                # get tokens
-                tokens = call_get_first_time_token(
-                    CODE)  # only need to call this once!
+            # the tokens of each authorization code are exchanged once and
+            # then refreshed in the background before they expire
+            token_manager = call_get_token_manager()
+            if CODE not in token_manager:
+                token_manager.exchange_code(CODE)
+            tokens = token_manager.get(CODE)
+
+            # the activity is fetched once and shared by the map and the
+            # segments sorting
+            activity = call_get_activity(tokens, ACTIVITY_ID)
 
             # display map from activity
             df_activity_coordinates = get_activity_coordinates(
-                ACTIVITY_ID, tokens)
+                ACTIVITY_ID, tokens, activity=activity)
             st.header("Activity map")
             # st.map(df_activity_coordinates)
             activity_map = create_map(df_activity_coordinates, 'dark')
@@ -72,12 +80,39 @@ def main():
             filter_type = 'climbs'
             GENDER = 'mens'
             pr_filter = None
-            df_segments = copy.deepcopy(
-                call_segments_sorting(tokens=tokens,
-                                      activity_id=ACTIVITY_ID,
-                                      gender=GENDER,
-                                      filter_type=filter_type,
-                                      pr_filter=pr_filter))
+            # the cached frame is shared by the reruns, so it's never
+            # modified in place
+            df_segments = call_segments_sorting(tokens=tokens,
+                                                activity_id=ACTIVITY_ID,
+                                                gender=GENDER,
+                                                filter_type=filter_type,
+                                                pr_filter=pr_filter)
+
+            # the maps of the top segments are prepared in the background,
+            # so switching between them doesn't wait for the network
+            segment_maps = call_get_segment_map_prefetcher()
+            segment_maps.prefetch(df_segments["segment.id"],
+                                  tokens,
+                                  n=PREFETCHED_SEGMENTS)
+
+            # every segment of the activity, not only the ranked ones
+            df_efforts = efforts_to_frame(activity['segment_efforts'])
+
+            # keep the segments of the activity in the index of known segments
+            segment_index = call_load_segment_index()
+            if segment_index.add_efforts(df_efforts):
+                segment_index.save()
+
+            # keep every effort of the activity in the history of its
+            # athlete, only the history of the athlete using the app is shown
+            athlete_id = call_get_athlete(tokens)["id"]
+            history = call_load_history(athlete_id)
+            if activity["athlete"]["id"] == athlete_id and \
+                    ACTIVITY_ID not in history:
+                history.add_efforts(
+                    df_efforts,
+                    ACTIVITY_ID,
+                    df_segments.set_index("segment.id")["leader_time"])
 
             # TODO: format segments dataframe to show only valuable information
             # displays the segments dataframe with a checkbox to select on the
@@ -90,6 +125,12 @@ def main():
             # df_segments_filtered = df_segments
             st.write(format_segments_table(df_segments))
 
+            st.header("Your segments closest to the leader, all time")
+            st.write(history.closest_to_leader(20)[[
+                "name", "n_efforts", "best_time", "leader_time",
+                "difference_from_leader", "trend"
+            ]])
+
             # select segment to analyse
             segment_name = st.selectbox("Select a segment to visualize",
                                         df_segments["name"].unique())
@@ -99,71 +140,120 @@ def main():
                                          'segment.id'].values[0]
 
             # display segment map
-            df_segment_coordinates = get_segment_coordinates(
-                str(segment_id), tokens)
+            df_segment_coordinates, segment_map = segment_maps.get(
+                segment_id, tokens)
             st.header("Segment map")
             # st.map(df_segment_coordinates)
-            segment_map = create_map(df_segment_coordinates, 'outdoors')
             st.pydeck_chart(segment_map)
 
-            # Segment insights plots
-            st.header(
-                "How the distance of the segment impacts your proximity to the Strava leader"  # noqa: E501
-            )
-            st.plotly_chart(
-                plot_segments_insights(df_segments, "segment.distance",
-                                       "Segment Distance (Km)"))
-
-            st.header(
-                "How the distance of the segment impacts your proximity to the Strava leader"  # noqa: E501
-            )
-            st.plotly_chart(
-                plot_segments_insights(df_segments, "elapsed_time",
-                                       "Time (hh:mm:ss)"))
-
-            st.header(
-                "How the average grade of the segment impacts your proximity to the Strava leader"  # noqa: E501
-            )
-            st.plotly_chart(
-                plot_segments_insights(df_segments, "segment.average_grade",
-                                       "Average grade (%)"))
-
-            st.header(
-                "How the elevation difference of the segment impacts your proximity to the Strava leader"  # noqa: E501
-            )
-            st.plotly_chart(
-                plot_segments_insights(df_segments, "elevation_difference",
-                                       "Elevation Difference (m)"))
-            st.header(
-                "How the average power varies with the proximity to the Strava leader"  # noqa: E501
-            )
-            st.plotly_chart(
-                plot_segments_insights(df_segments, "average_watts",
-                                       "Average Power (W)"))
-
-
-@st.cache
-def call_get_first_time_token(CODE):
-    return get_first_time_token(CODE)
-
-
-@st.cache
-def call_refresh_access_token_if_expired(tokens):
-    return refresh_access_token_if_expired(tokens)
+            # Segment insights plots, only the selected ones are built
+            insights = st.multiselect("Select the insights to show",
+                                      list(INSIGHTS),
+                                      default=list(INSIGHTS)[:1])
+
+            if "stream_max_watts" in [INSIGHTS[i][0] for i in insights]:
+                # per-second data of each effort from the activity streams
+                try:
+                    df_segments = add_stream_metrics(
+                        df_segments,
+                        call_get_streams(tokens, ACTIVITY_ID,
+                                         activity["athlete"]["id"]))
+                except ValueError as e:
+                    logger.info(e)
+
+            available = []
+            for insight in insights:
+                y = INSIGHTS[insight][0]
+                if y not in df_segments or df_segments[y].isna().all():
+                    st.info(f"There is no data for: {insight}")
+                else:
+                    available.append(insight)
+
+            # the data shared by the charts is prepared once
+            figures = plot_insights(df_segments,
+                                    [INSIGHTS[i] for i in available])
+            for insight, figure in zip(available, figures):
+                st.header(insight)
+                st.plotly_chart(figure)
+
+
+# The manager holds the tokens of every session and refreshes them in place
+@st.cache(allow_output_mutation=True)
+def call_get_token_manager():
+    return TokenManager()
+
+
+# The returned activity is never mutated, so st.cache doesn't need to hash it
+@st.cache(allow_output_mutation=True)
+def call_get_activity(tokens, activity_id):
+    return get_activity(activity_id, tokens)
+
+
+# The streams are stored on disk, in the directory of the athlete of the
+# activity, and returned as a read-only memory map
+@st.cache(allow_output_mutation=True)
+def call_get_streams(tokens, activity_id, athlete_id):
+    return StreamStore(streams_dir(athlete_id)).fetch(activity_id, tokens)
+
+
+# The index is shared by every session and updated in place
+@st.cache(allow_output_mutation=True)
+def call_load_segment_index():
+    return SegmentIndex.load()
+
+
+# The maps of segments are shared by every session
+@st.cache(allow_output_mutation=True)
+def call_get_segment_map_prefetcher():
+    return SegmentMapPrefetcher(map_style='outdoors')
+
+
+# The athlete of the tokens, whose history is shown
+@st.cache(allow_output_mutation=True)
+def call_get_athlete(tokens):
+    return get_athlete(tokens)
+
+
+# The history of each athlete is stored on disk and shared by its sessions
+@st.cache(allow_output_mutation=True)
+def call_load_history(athlete_id):
+    return EffortHistory(history_path(athlete_id))
 
 
 # This functions calls the function that sorts the segments from the pystrava
 # module. In order to apply the cache option, the function that loads the data
 # needs to be defined in this script (so it's a workaround to use
-# sort_segments_from_activity() cached
-@st.cache
+# sort_segments_from_activity() cached. The returned frame is never mutated,
+# so st.cache doesn't need to hash it nor copy it
+@st.cache(allow_output_mutation=True)
 def call_segments_sorting(tokens, activity_id, gender, filter_type, pr_filter):
-    return sort_segments_from_activity(tokens=tokens,
-                                       activity_id=activity_id,
-                                       gender=gender,
-                                       filter_type=filter_type,
-                                       pr_filter=pr_filter)
+    return sort_segments_from_activity(
+        tokens=tokens,
+        activity_id=activity_id,
+        gender=gender,
+        filter_type=filter_type,
+        pr_filter=pr_filter,
+        activity=call_get_activity(tokens, activity_id))
+
 
+# Insight charts: title, column and axis label
+INSIGHTS = {
+    "How the distance of the segment impacts your proximity to the Strava leader":  # noqa: E501
+    ("segment.distance", "Segment Distance (Km)"),
+    "How the elapsed time of the segment impacts your proximity to the Strava leader":  # noqa: E501
+    ("elapsed_time", "Time (hh:mm:ss)"),
+    "How the average grade of the segment impacts your proximity to the Strava leader":  # noqa: E501
+    ("segment.average_grade", "Average grade (%)"),
+    "How the elevation difference of the segment impacts your proximity to the Strava leader":  # noqa: E501
+    ("elevation_difference", "Elevation Difference (m)"),
+    "How the average power varies with the proximity to the Strava leader":  # noqa: E501
+    ("average_watts", "Average Power (W)"),
+    "How the maximum power varies with the proximity to the Strava leader":  # noqa: E501
+    ("stream_max_watts", "Maximum Power (W)"),
+}
+
+# number of top ranked segments whose maps are prepared in the background
+PREFETCHED_SEGMENTS = 10
 
 # General parameters
 # ACTIVITY_ID = '4074378152'
@@ -173,5 +263,31 @@ CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
 logger = logging.getLogger("pystrava")
 
+
+def show_timings(page_trace):
+    """ Debug panel with the timings of this run and of the process """
+
+    if not st.sidebar.checkbox("Show timings"):
+        return
+
+    st.sidebar.markdown(f"**This run: {page_trace.duration:.2f}s**")
+    st.sidebar.table(page_trace.summary())
+    st.sidebar.write(page_trace.counters)
+
+    stats = METRICS.stats()
+    st.sidebar.markdown("**All runs**")
+    st.sidebar.table([{
+        "stage": stage,
+        **summary
+    } for stage, summary in stats["stages"].items()])
+    st.sidebar.write(stats["counters"])
+
+
 if __name__ == "__main__":
-    main()
+    with trace("page") as page_trace:
+        try:
+            main()
+        except RateLimitExceeded as e:
+            # the budget is shared by every session, so only this run stops
+            st.error(f"{e}, please try again later")
+    show_timings(page_trace)
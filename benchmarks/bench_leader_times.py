@@ -0,0 +1,45 @@
+""" Compares sequential and concurrent leader time retrieval
+
+Usage:
+    ACCESS_TOKEN=... python -m benchmarks.bench_leader_times ACTIVITY_ID
+                                                        [MAX_WORKERS]
+"""
+
+import os
+import sys
+import time
+
+import pystrava.client
+from pystrava.client import StravaClient
+from pystrava.segments import _get_segments_from_activity, _get_leader_times
+
+
+def main(activity_id, max_workers=8):
+
+    # without cache, so the concurrent pass makes the same requests as the
+    # sequential one instead of reading its responses
+    pystrava.client._client = StravaClient(cache=None)
+
+    tokens = {"access_token": os.getenv("ACCESS_TOKEN")}
+    segment_ids = _get_segments_from_activity(activity_id,
+                                              tokens)["segment.id"]
+
+    timings = {}
+    results = {}
+    for workers in [1, max_workers]:
+        start = time.perf_counter()
+        results[workers] = _get_leader_times(segment_ids,
+                                             gender="men",
+                                             tokens=tokens,
+                                             max_workers=workers)
+        timings[workers] = time.perf_counter() - start
+
+    print(f"segments: {len(segment_ids)}")
+    print(f"sequential: {timings[1]:.2f}s")
+    print(f"concurrent ({max_workers} workers): {timings[max_workers]:.2f}s")
+    print(f"speedup: {timings[1] / timings[max_workers]:.1f}x")
+    print(f"identical results: {results[1].equals(results[max_workers])}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,64 @@
+""" Compares polyline.decode with the NumPy decoder of pystrava
+
+Usage:
+    python -m benchmarks.bench_polyline [N_POLYLINES] [N_POINTS]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import polyline
+
+from pystrava.transformations import decode_polyline, decode_polylines
+
+
+def random_polylines(n_polylines, n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    polylines = []
+    for _ in range(n_polylines):
+        start = [rng.uniform(-60, 60), rng.uniform(-170, 170)]
+        points = start + np.cumsum(rng.normal(0, 1e-4, (n_points, 2)), axis=0)
+        polylines.append(polyline.encode([tuple(p) for p in points]))
+    return polylines
+
+
+def timeit(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main(n_polylines=200, n_points=2000):
+
+    polylines = random_polylines(n_polylines, n_points)
+
+    t_reference, reference = timeit(lambda: [
+        pd.DataFrame(polyline.decode(p), columns=["latitude", "longitude"])
+        for p in polylines
+    ])
+    t_single, single = timeit(lambda: [
+        pd.DataFrame(decode_polyline(p), columns=["latitude", "longitude"])
+        for p in polylines
+    ])
+    t_batch, batch = timeit(lambda: decode_polylines(polylines))
+
+    identical = all(
+        r.equals(s) and np.array_equal(r.to_numpy(), b)
+        for r, s, b in zip(reference, single, batch))
+
+    print(f"{n_polylines} polylines of {n_points} points")
+    print(f"polyline.decode + DataFrame: {t_reference * 1000:.1f} ms")
+    print(f"decode_polyline + DataFrame: {t_single * 1000:.1f} ms "
+          f"({t_reference / t_single:.1f}x)")
+    print(f"decode_polylines (batch): {t_batch * 1000:.1f} ms "
+          f"({t_reference / t_batch:.1f}x)")
+    print(f"identical results: {identical}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,56 @@
+""" Measures the import time of the app modules in fresh interpreters
+
+Usage:
+    python -m benchmarks.bench_startup [REPEAT]
+"""
+
+import sys
+import json
+import statistics
+import subprocess
+
+MODULES = [
+    "pystrava.segments", "pystrava.maps", "pystrava.plots",
+    "pystrava.transformations", "app"
+]
+
+# modules that should only be loaded when a map or a chart is built
+HEAVY_MODULES = ["pydeck", "plotly", "plotly.express", "streamlit"]
+
+SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start,
+                  [m for m in {heavy} if m in sys.modules]]))
+"""
+
+
+def import_time(module):
+    """ Returns the import time and the heavy modules loaded by it """
+
+    output = subprocess.run(
+        [sys.executable, "-c",
+         SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main(repeat=5):
+
+    for module in MODULES:
+        try:
+            timings, loaded = zip(
+                *[import_time(module) for _ in range(repeat)])
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<26} failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        print(f"{module:<26} {statistics.median(timings):.3f}s "
+              f"loads: {', '.join(loaded[0]) or '-'}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
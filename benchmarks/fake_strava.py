@@ -0,0 +1,353 @@
+""" Local stand-in for the Strava API
+
+Serves /api/v3/activities, /api/v3/segments, /api/v3/athlete,
+/api/v3/athlete/activities, /api/v3/activities/{id}/streams and
+/oauth/token from synthetic or recorded fixtures, with a configurable
+latency and rate limit headers.
+
+Usage:
+    python -m benchmarks.fake_strava [--port 8000] [--latency 0.05]
+    STRAVA_URL=http://127.0.0.1:8000 streamlit run app.py
+
+Recorded fixtures are JSON files named like the endpoint they replace,
+e.g. activities_4074378152.json or segments_229781.json, and can be
+captured from the real API with record_fixtures.
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import polyline
+
+from pystrava.client import get_client
+
+# number of segment efforts and of points of the activity polyline
+ACTIVITY_SIZES = {
+    "small": (10, 2000),
+    "medium": (60, 10000),
+    "huge": (600, 60000),
+}
+
+# owner of every synthetic activity
+SYNTHETIC_ATHLETE_ID = 1
+
+# the usage of the short limit is reset every 15 minutes and the one of
+# the long limit at midnight UTC
+RATE_LIMIT_WINDOWS = [900, 86400]
+
+
+def synthetic_fixtures(size="medium", activity_id=1, seed=0) -> dict:
+    """ Creates the responses of a synthetic activity and its segments """
+
+    n_segments, n_points = ACTIVITY_SIZES[size]
+    rng = np.random.default_rng(seed)
+
+    # a wandering ride around Amsterdam, one sample per second
+    steps = rng.normal(0, 5e-5, (n_points, 2)) + [2e-5, 3e-5]
+    track = np.array([52.35, 4.9]) + np.cumsum(steps, axis=0)
+    altitude = 10 + np.cumsum(rng.normal(0, 0.2, n_points))
+    # meters per degree of latitude and of longitude at this latitude
+    legs = np.diff(track, axis=0) * [111e3, 68e3]
+    distance = np.concatenate([[0], np.cumsum(np.hypot(*legs.T))])
+
+    fixtures = {}
+    efforts = []
+    for i in range(n_segments):
+        start = int(rng.integers(0, n_points - 200))
+        end = start + int(rng.integers(30, 200))
+        segment_id = 1000 * activity_id + i
+        grade = float(rng.normal(2, 4))
+        elapsed_time = end - start
+        segment = {
+            "id": segment_id,
+            "name": f"Segment {i}",
+            "activity_type": "Ride",
+            "distance": float(distance[end] - distance[start]),
+            "average_grade": round(grade, 1),
+            "elevation_high": float(altitude[start:end + 1].max()),
+            "elevation_low": float(altitude[start:end + 1].min()),
+            "climb_category": int(max(0, min(5, grade // 2))),
+            "city": "Amsterdam",
+            "start_latlng": track[start].tolist(),
+            "end_latlng": track[end].tolist(),
+        }
+        fixtures[f"segments/{segment_id}"] = dict(
+            segment,
+            map={"polyline": polyline.encode(track[start:end + 1].tolist())},
+            xoms={
+                "kom": _format_time(int(elapsed_time * rng.uniform(0.5, 1))),
+                "qom": _format_time(int(elapsed_time * rng.uniform(0.6, 1)))
+            })
+        efforts.append({
+            "id": 10**6 * activity_id + i,
+            "name": segment["name"],
+            "start_date": "2020-09-17T15:45:30Z",
+            "elapsed_time": elapsed_time,
+            "moving_time": elapsed_time,
+            "distance": segment["distance"],
+            "start_index": start,
+            "end_index": end,
+            "average_watts": float(rng.uniform(150, 350)),
+            "pr_rank": [None, 1, 2, 3][i % 4],
+            "achievements": [],
+            "segment": segment
+        })
+
+    fixtures["athlete"] = {
+        "id": SYNTHETIC_ATHLETE_ID,
+        "firstname": "Synthetic"
+    }
+    fixtures[f"activities/{activity_id}"] = {
+        "id": activity_id,
+        "athlete": {
+            "id": SYNTHETIC_ATHLETE_ID,
+            "resource_state": 1
+        },
+        "name": f"Synthetic {size} ride",
+        "type": "Ride",
+        "start_date": "2020-09-17T15:45:30Z",
+        "start_date_local": "2020-09-17T17:45:30Z",
+        "distance": float(distance[-1]),
+        "moving_time": n_points,
+        "elapsed_time": n_points,
+        "total_elevation_gain":
+        float(np.clip(np.diff(altitude), 0, None).sum()),
+        "map": {
+            "polyline": polyline.encode(track.tolist()),
+            "summary_polyline": polyline.encode(track[::20].tolist())
+        },
+        "segment_efforts": efforts
+    }
+    fixtures[f"activities/{activity_id}/streams"] = {
+        "time": {"data": list(range(n_points))},
+        "latlng": {"data": track.round(6).tolist()},
+        "distance": {"data": distance.round(1).tolist()},
+        "altitude": {"data": altitude.round(1).tolist()},
+        "watts": {"data": rng.uniform(100, 400, n_points).round().tolist()},
+    }
+
+    return fixtures
+
+
+def _format_time(seconds):
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def _timestamp(date):
+    return datetime.strptime(date, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+
+
+def load_fixtures(directory) -> dict:
+    """ Loads recorded fixtures saved by record_fixtures """
+
+    fixtures = {}
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                fixtures[name[:-5].replace("_", "/")] = json.load(f)
+    return fixtures
+
+
+def record_fixtures(activity_id, tokens, directory):
+    """
+    Saves the responses of the real API for an activity and its segments,
+    so they can be replayed by the stand-in
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    client = get_client()
+
+    endpoints = [f"activities/{activity_id}"]
+    activity = client.get(endpoints[0], tokens)
+    endpoints += [
+        f"segments/{effort['segment']['id']}"
+        for effort in activity.get("segment_efforts", [])
+    ]
+
+    for endpoint in endpoints:
+        response = activity if endpoint == endpoints[0] else client.get(
+            endpoint, tokens)
+        with open(os.path.join(directory,
+                               endpoint.replace("/", "_") + ".json"),
+                  "w") as f:
+            json.dump(response, f)
+
+
+class FakeStrava:
+    """
+    Local HTTP server that answers like the Strava API from fixtures. It
+    sleeps latency seconds per request and reports the usage in the rate
+    limit headers, answering 429 once the short or long limit is exceeded
+    until the usage is reset
+    """
+
+    def __init__(self,
+                 fixtures: dict,
+                 latency: float = 0.05,
+                 short_limit: int = 600,
+                 long_limit: int = 30000,
+                 port: int = 0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.limits = [short_limit, long_limit]
+        self.usage = [0, 0]
+        self._windows = self._current_windows()
+        self.requests = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port),
+                                          self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+            # headers and body are separate writes, which would wait for
+            # the delayed ACK of the client on kept-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                match = re.fullmatch(r"/api/v3/(.+)", path)
+                endpoint = match.group(1) if match else path
+                if endpoint == "athlete/activities":
+                    body = fake._athlete_activities(self.path)
+                else:
+                    body = fake.fixtures.get(endpoint)
+                self._respond(endpoint, body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._respond(
+                    "oauth/token", {
+                        "access_token": "fake-access-token",
+                        "refresh_token": "fake-refresh-token",
+                        "expires_at": int(time.time()) + 6 * 3600
+                    })
+
+            def _respond(self, endpoint, body):
+                time.sleep(fake.latency)
+
+                with fake._lock:
+                    fake.requests.append(endpoint)
+                    windows = fake._current_windows()
+                    fake.usage = [
+                        u + 1 if window == previous else 1
+                        for u, window, previous in zip(
+                            fake.usage, windows, fake._windows)
+                    ]
+                    fake._windows = windows
+                    exceeded = any(
+                        u > limit for u, limit in zip(fake.usage, fake.limits))
+                    usage = list(fake.usage)
+
+                if exceeded:
+                    status, body = 429, {
+                        "message": "Rate Limit Exceeded",
+                        "errors": []
+                    }
+                elif body is None:
+                    status, body = 404, {
+                        "message": "Record Not Found",
+                        "errors": []
+                    }
+                else:
+                    status = 200
+
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-RateLimit-Limit",
+                                 ",".join(map(str, fake.limits)))
+                self.send_header("X-RateLimit-Usage", ",".join(map(str,
+                                                                   usage)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def _current_windows():
+        now = time.time()
+        return [int(now // window) for window in RATE_LIMIT_WINDOWS]
+
+    def _athlete_activities(self, path):
+        query = parse_qs(urlsplit(path).query)
+        page = int(query.get("page", [1])[-1])
+        per_page = int(query.get("per_page", [30])[-1])
+        after = float(query.get("after", [0])[-1])
+        activities = [
+            {k: v for k, v in body.items() if k != "segment_efforts"}
+            for endpoint, body in sorted(self.fixtures.items())
+            if re.fullmatch(r"activities/\d+", endpoint)
+            and _timestamp(body["start_date"]) > after
+        ]
+        return activities[(page - 1) * per_page:page * per_page]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Strava stand-in")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--size", default="medium", choices=ACTIVITY_SIZES)
+    parser.add_argument("--short-limit", type=int, default=600)
+    parser.add_argument("--long-limit", type=int, default=30000)
+    parser.add_argument("--fixtures", help="directory of recorded fixtures")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else \
+        synthetic_fixtures(args.size)
+
+    fake = FakeStrava(fixtures,
+                      latency=args.latency,
+                      short_limit=args.short_limit,
+                      long_limit=args.long_limit,
+                      port=args.port)
+    print(f"Serving {len(fixtures)} fixtures on {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+""" End-to-end benchmarks against the local Strava stand-in
+
+Measures the segments ranking, the map building and the render of the
+activity page for small, medium and huge synthetic activities, so
+performance regressions can be tracked without Strava credentials.
+
+Usage:
+    python -m benchmarks.run [--sizes small medium huge] [--repeat 3]
+                             [--latency 0.05] [--json results.json]
+"""
+
+import json
+import time
+import argparse
+import statistics
+
+import pystrava.client
+from pystrava.client import StravaClient
+from pystrava.activities import get_activity
+from pystrava.segments import sort_segments_from_activity, format_segments_table  # noqa: E501
+from pystrava.transformations import get_segment_coordinates, get_activity_coordinates  # noqa: E501
+from pystrava.maps import create_map
+from pystrava.plots import plot_insights
+
+from benchmarks.fake_strava import ACTIVITY_SIZES, FakeStrava, synthetic_fixtures  # noqa: E501
+
+ACTIVITY_ID = 1
+TOKENS = {"access_token": "fake-access-token"}
+
+
+def render_page(tokens, activity_id):
+    """ Runs the same steps as app.py for an activity, without streamlit """
+
+    activity = get_activity(activity_id, tokens)
+    df_activity_coordinates = get_activity_coordinates(activity_id,
+                                                       tokens,
+                                                       activity=activity)
+    create_map(df_activity_coordinates, 'dark').to_json()
+
+    df_segments = sort_segments_from_activity(tokens=tokens,
+                                              activity_id=activity_id,
+                                              gender='mens',
+                                              filter_type='climbs',
+                                              activity=activity)
+    table = format_segments_table(df_segments)
+    # Styler.render was renamed to to_html in newer pandas
+    table.to_html() if hasattr(table, "to_html") else table.render()
+
+    segment_id = df_segments["segment.id"].values[0]
+    df_segment_coordinates = get_segment_coordinates(str(segment_id), tokens)
+    create_map(df_segment_coordinates, 'outdoors').to_json()
+
+    for figure in plot_insights(
+            df_segments, [("segment.distance", "Segment Distance (Km)"),
+                          ("elapsed_time", "Time (hh:mm:ss)"),
+                          ("segment.average_grade", "Average grade (%)"),
+                          ("elevation_difference", "Elevation Difference (m)"),
+                          ("average_watts", "Average Power (W)")]):
+        figure.to_json()
+
+
+def _time(fn, repeat):
+    """ Returns the timings in seconds of repeat calls to fn """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(size, repeat=3, latency=0.05):
+    """ Runs every benchmark for an activity size """
+
+    fixtures = synthetic_fixtures(size, ACTIVITY_ID)
+
+    # limits high enough for every repetition, the rate limiter is
+    # exercised by running the stand-in on its own
+    with FakeStrava(fixtures,
+                    latency=latency,
+                    short_limit=10**6,
+                    long_limit=10**7) as fake:
+        # a fresh client without cache, so every run makes the requests
+        pystrava.client._client = StravaClient(
+            base_url=fake.url + "/api/v3/",
+            oauth_url=fake.url + "/oauth/token",
+            cache=None)
+
+        activity = get_activity(ACTIVITY_ID, TOKENS)
+        df_coordinates = get_activity_coordinates(ACTIVITY_ID,
+                                                  TOKENS,
+                                                  activity=activity)
+
+        benchmarks = {
+            "sort_segments":
+            lambda: sort_segments_from_activity(TOKENS,
+                                                ACTIVITY_ID,
+                                                gender='mens',
+                                                filter_type='climbs',
+                                                activity=activity),
+            "create_map":
+            lambda: create_map(df_coordinates, 'dark').to_json(),
+            "render_page":
+            lambda: render_page(TOKENS, ACTIVITY_ID),
+        }
+
+        results = []
+        for name, fn in benchmarks.items():
+            n_requests = len(fake.requests)
+            timings = _time(fn, repeat)
+            results.append({
+                "size": size,
+                "benchmark": name,
+                "median_s": statistics.median(timings),
+                "min_s": min(timings),
+                "requests": (len(fake.requests) - n_requests) // repeat
+            })
+
+    pystrava.client._client = None
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes",
+                        nargs="+",
+                        default=list(ACTIVITY_SIZES),
+                        choices=ACTIVITY_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.05,
+                        help="seconds per request of the stand-in")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results += run(size, args.repeat, args.latency)
+
+    print(f"{'size':<8} {'benchmark':<15} {'median':>9} {'min':>9} "
+          f"{'requests':>9}")
+    for r in results:
+        print(f"{r['size']:<8} {r['benchmark']:<15} {r['median_s']:>8.3f}s "
+              f"{r['min_s']:>8.3f}s {r['requests']:>9}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+""" Functions for retrieving activities """
+
+import logging
+
+from pystrava.client import get_client
+from pystrava.ratelimit import PRIORITY_HIGH
+from pystrava.utils import check_rate_limit_exceeded
+
+logger = logging.getLogger("pystrava")
+
+
+def get_activity(activity_id, tokens):
+    """
+    Gets the detailed representation of an activity, which contains both the
+    map polyline and the segment efforts, so it can be fetched once and
+    parsed by get_activity_coordinates and sort_segments_from_activity
+    """
+
+    logger.info("Loading activity...")
+
+    # make GET request to Strava API
+    req = get_client().get("activities/{}".format(activity_id),
+                           tokens,
+                           priority=PRIORITY_HIGH)
+
+    # check if rate limit is exceeded
+    check_rate_limit_exceeded(req)
+
+    logger.info("Loading activity...done!")
+
+    return req
+
+
+def get_athlete(tokens):
+    """ Gets the athlete the tokens belong to """
+
+    # make GET request to Strava API
+    req = get_client().get("athlete", tokens, priority=PRIORITY_HIGH)
+
+    # check if rate limit is exceeded
+    check_rate_limit_exceeded(req)
+
+    return req
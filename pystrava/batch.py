@@ -0,0 +1,205 @@
+""" Ranking of the segments of many activities at once
+
+Usage:
+    python -m pystrava.batch --sync --output ranked.parquet
+                             [--since 2020-01-01]
+
+The tokens are read from the ACCESS_TOKEN, REFRESH_TOKEN and EXPIRES_AT
+environment variables, see .env_dist
+"""
+
+import os
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from pystrava.activities import get_activity, get_athlete
+from pystrava.curves import sync_curves
+from pystrava.history import EffortHistory, history_path
+from pystrava.segments import efforts_to_frame, _get_leader_times, _rank_segments  # noqa: E501
+from pystrava.sync import load_activities, sync_activities, DEFAULT_ACTIVITIES_PATH  # noqa: E501
+from pystrava.utils import refresh_access_token_if_expired
+
+logger = logging.getLogger("pystrava")
+
+
+def rank_activities(activity_ids,
+                    tokens,
+                    gender,
+                    filter_type=None,
+                    pr_filter=None,
+                    max_workers=8) -> pd.DataFrame:
+    """
+    Ranks the segment efforts of several activities in a single table.
+    Activities are fetched concurrently and the leader time of a segment
+    ridden in several activities is only fetched once
+    :param activity_ids: ids of the activities to rank
+    :param tokens: Strava tokens
+    :param gender: 'women' to compare with the QOM, the KOM otherwise
+    :param filter_type: 'climbs' to keep only categorized climbs
+    :param pr_filter: keep only efforts with a PR rank up to this value
+    :param max_workers: number of concurrent requests
+    :return: segment efforts of every activity sorted by the difference
+        from the leader, with activity_id and athlete_id columns
+    """
+
+    activity_ids = list(dict.fromkeys(activity_ids))
+    logger.info(f"Loading {len(activity_ids)} activities...")
+
+    def fetch(activity_id):
+        try:
+            activity = get_activity(activity_id, tokens)
+            efforts = activity['segment_efforts']
+        except Exception:
+            logger.info(f"Couldn't retrieve the following activity: {activity_id}")  # noqa: E501
+            return None
+
+        athlete_id = activity.get("athlete", {}).get("id")
+        return [
+            dict(effort, activity_id=activity_id, athlete_id=athlete_id)
+            for effort in efforts
+        ]
+
+    # requests are I/O bound and share the client's rate limiter and
+    # connection pool, so threads are used rather than processes
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        efforts = [
+            effort for activity_efforts in executor.map(fetch, activity_ids)
+            if activity_efforts is not None for effort in activity_efforts
+        ]
+
+    if not efforts:
+        return pd.DataFrame()
+
+    # a single frame, so the categories are shared by every activity
+    df_segments = efforts_to_frame(efforts)
+    df_segments["activity_id"] = [
+        effort["activity_id"] for effort in efforts
+    ]
+    df_segments["athlete_id"] = pd.array(
+        [effort["athlete_id"] for effort in efforts], dtype="Int64")
+    logger.info("Loading activities...done! "
+                f"{df_segments.shape[0]} segment efforts.")
+
+    if filter_type == 'climbs':
+        df_segments = df_segments[df_segments['segment.climb_category'] > 0]
+
+    if pr_filter in [1, 2, 3]:
+        df_segments = df_segments[df_segments['pr_rank'] <= pr_filter]
+
+    # each segment's leader time is fetched once
+    segment_ids = df_segments["segment.id"].drop_duplicates()
+    logger.info(f"Sorting {df_segments.shape[0]} segment efforts over "
+                f"{len(segment_ids)} distinct segments...")
+    leader_times = _get_leader_times(segment_ids,
+                                     gender=gender,
+                                     tokens=tokens,
+                                     max_workers=max_workers)
+    leader_times = pd.Series(leader_times.values, index=segment_ids.values)
+
+    df_segments = _rank_segments(
+        df_segments, df_segments["segment.id"].map(leader_times))
+    logger.info("Sorting segment efforts...done!")
+
+    return df_segments.reset_index(drop=True)
+
+
+def write_table(df: pd.DataFrame, path: str):
+    """ Writes a table as Parquet or CSV depending on the file extension """
+
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    else:
+        flatten_nested(df).to_parquet(path, index=False)
+
+
+def flatten_nested(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Nested values (lists of achievements, coordinates...) can't always be
+    inferred by Parquet or Arrow, so they are converted to strings
+    """
+
+    nested = [
+        c for c in df.columns if df[c].dtype == object
+        and df[c].map(lambda v: isinstance(v, (list, dict))).any()
+    ]
+
+    return df.assign(**{c: df[c].astype(str) for c in nested})
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(
+        description="Rank the segments of many activities")
+    parser.add_argument("--ids",
+                        nargs="+",
+                        type=int,
+                        help="activity ids, by default the ones synced")
+    parser.add_argument("--activities",
+                        default=DEFAULT_ACTIVITIES_PATH,
+                        help="local activity list created by pystrava.sync")
+    parser.add_argument("--sync",
+                        action="store_true",
+                        help="sync the local activity list before ranking")
+    parser.add_argument("--since", help="only activities from this date")
+    parser.add_argument("--type", help="only activities of this type")
+    parser.add_argument("--gender", default="men", choices=["men", "women"])
+    parser.add_argument("--filter", dest="filter_type", choices=["climbs"])
+    parser.add_argument("--pr", dest="pr_filter", type=int, choices=[1, 2, 3])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--output", default="ranked_segments.parquet")
+    parser.add_argument("--history",
+                        action="store_true",
+                        help="add the ranked efforts to the effort history")
+    parser.add_argument("--curves",
+                        action="store_true",
+                        help="fetch the streams of the activities and update "
+                        "the all-time curves")
+    args = parser.parse_args(args)
+
+    tokens = {"access_token": os.getenv("ACCESS_TOKEN")}
+    if os.getenv("REFRESH_TOKEN"):
+        tokens = refresh_access_token_if_expired({
+            "access_token": os.getenv("ACCESS_TOKEN"),
+            "refresh_token": os.getenv("REFRESH_TOKEN"),
+            "expires_at": os.getenv("EXPIRES_AT") or 0
+        })
+
+    if args.ids:
+        activity_ids = args.ids
+    else:
+        if args.sync:
+            df_activities = sync_activities(tokens, args.activities)
+        else:
+            df_activities = load_activities(args.activities)
+        if args.since:
+            df_activities = df_activities[
+                df_activities["start_date_local"] >= pd.Timestamp(args.since)]
+        if args.type:
+            df_activities = df_activities[df_activities["type"] == args.type]
+        activity_ids = df_activities["id"].tolist()
+
+    df_ranked = rank_activities(activity_ids,
+                                tokens,
+                                gender=args.gender,
+                                filter_type=args.filter_type,
+                                pr_filter=args.pr_filter,
+                                max_workers=args.workers)
+
+    write_table(df_ranked, args.output)
+    logger.info(f"Wrote {df_ranked.shape[0]} ranked segment efforts to "
+                f"{args.output}")
+
+    if args.history and not df_ranked.empty:
+        # each athlete has its own history
+        for athlete_id, df_athlete in df_ranked.groupby("athlete_id"):
+            EffortHistory(history_path(athlete_id)).add_efforts(df_athlete)
+
+    if args.curves:
+        sync_curves(activity_ids, tokens, get_athlete(tokens)["id"])
+
+
+if __name__ == "__main__":
+    main()
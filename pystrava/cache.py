@@ -0,0 +1,170 @@
+""" Persistent cache for Strava API responses """
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                  "pystrava", "responses.sqlite")
+
+# time to live in seconds of the responses of each resource, resources that
+# are not listed are never cached
+DEFAULT_TTLS = {
+    "segments": 7 * 24 * 3600,
+    "activities": 3600,
+}
+
+logger = logging.getLogger("pystrava")
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of decoded JSON responses with a time to live per
+    resource and least recently used eviction once max_entries is reached.
+    The database file can be shared by several processes
+    """
+
+    def __init__(self,
+                 path: str = DEFAULT_CACHE_PATH,
+                 ttls: dict = None,
+                 max_entries: int = 20000):
+        """
+        :param path: location of the SQLite database file
+        :param ttls: time to live in seconds for each resource
+        :param max_entries: maximum number of responses kept in the cache
+        """
+        self.path = path
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                resource TEXT NOT NULL,
+                body TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_access
+                ON responses (last_access);
+            CREATE TABLE IF NOT EXISTS stats (
+                resource TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def is_cacheable(self, resource: str) -> bool:
+        return self.ttls.get(resource, 0) > 0
+
+    def get(self, key: str, resource: str, fallback: str = None):
+        """
+        Returns the cached response for key, or for fallback if there isn't
+        one for key, None if both are missing/expired
+        """
+
+        now = time.time()
+        connection = self._connection()
+        rows = dict(
+            connection.execute(
+                """SELECT key, body FROM responses
+                   WHERE key IN (?, ?) AND expires_at > ?""",
+                (key, key if fallback is None else fallback, now)))
+        key = key if key in rows else fallback
+        row = (rows[key], ) if key in rows else None
+
+        if row is not None:
+            connection.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (now, key))
+
+        self._record(resource, hit=row is not None)
+
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key: str, resource: str, value):
+        """ Stores a response and evicts the least recently used ones """
+
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, resource, json.dumps(value),
+             now + self.ttls.get(resource, 0), now))
+
+        n_entries = connection.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+        if n_entries > self.max_entries:
+            connection.execute(
+                """DELETE FROM responses WHERE key IN (
+                       SELECT key FROM responses
+                       ORDER BY expires_at <= ? DESC, last_access
+                       LIMIT ?)""", (now, n_entries - self.max_entries))
+
+    def items(self, resource: str):
+        """ Iterates over the keys and responses stored for a resource """
+
+        rows = self._connection().execute(
+            "SELECT key, body FROM responses WHERE resource = ?",
+            (resource, ))
+        for key, body in rows:
+            yield key, json.loads(body)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM responses")
+
+    def _record(self, resource, hit):
+        column = "hits" if hit else "misses"
+
+        with self._stats_lock:
+            counts = self._stats.setdefault(resource, {"hits": 0, "misses": 0})
+            counts[column] += 1
+
+        self._connection().execute(
+            f"""INSERT INTO stats (resource, {column}) VALUES (?, 1)
+                ON CONFLICT (resource)
+                DO UPDATE SET {column} = {column} + 1""", (resource, ))
+
+    def stats(self, persistent: bool = False) -> dict:
+        """
+        Returns the hits and misses per resource of this process, or the
+        ones accumulated by every process using the cache if persistent
+        """
+
+        if persistent:
+            rows = self._connection().execute(
+                "SELECT resource, hits, misses FROM stats").fetchall()
+            stats = {r: {"hits": h, "misses": m} for r, h, m in rows}
+        else:
+            with self._stats_lock:
+                stats = {r: dict(c) for r, c in self._stats.items()}
+
+        for counts in stats.values():
+            total = counts["hits"] + counts["misses"]
+            counts["hit_rate"] = counts["hits"] / total if total else 0.0
+
+        n_entries = self._connection().execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        return {"entries": n_entries, "resources": stats}
@@ -0,0 +1,192 @@
+""" HTTP client shared by all the Strava API calls """
+
+import os
+import hashlib
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pystrava.cache import ResponseCache, DEFAULT_CACHE_PATH
+from pystrava.ratelimit import RateLimiter, PRIORITY_NORMAL
+from pystrava.singleflight import SingleFlight
+from pystrava.timing import timed, increment
+
+# STRAVA_URL points the client to another server, e.g. a local stand-in
+STRAVA_URL = os.getenv("STRAVA_URL", "https://www.strava.com").rstrip("/")
+BASE_URL = STRAVA_URL + "/api/v3/"
+OAUTH_URL = STRAVA_URL + "/oauth/token"
+
+# fields of a segment that are the same for every athlete, the rest (e.g.
+# athlete_segment_stats or starred) belong to the athlete who fetched it
+SHARED_SEGMENT_FIELDS = [
+    "id", "resource_state", "name", "activity_type", "distance",
+    "average_grade", "maximum_grade", "elevation_high", "elevation_low",
+    "start_latlng", "end_latlng", "climb_category", "city", "state",
+    "country", "private", "hazardous", "created_at", "updated_at",
+    "total_elevation_gain", "map", "effort_count", "athlete_count",
+    "star_count", "xoms"
+]
+
+logger = logging.getLogger("pystrava")
+
+
+class StravaClient:
+    """
+    Wraps a pooled keep-alive requests.Session, so connections to Strava
+    are reused between calls instead of opening a new TCP+TLS connection
+    for every request
+    """
+
+    def __init__(self,
+                 base_url: str = BASE_URL,
+                 oauth_url: str = OAUTH_URL,
+                 timeout: tuple = (3.05, 30),
+                 pool_maxsize: int = 16,
+                 cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None):
+        """
+        :param base_url: root URL of the Strava API
+        :param oauth_url: URL of the OAuth token endpoint
+        :param timeout: (connect, read) timeout in seconds for every request
+        :param pool_maxsize: number of connections kept alive per host
+        :param cache: cache for the responses of GET requests, or None
+        :param rate_limiter: scheduler of the requests made to the API
+        """
+        self.base_url = base_url
+        self.oauth_url = oauth_url
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = RateLimiter(
+        ) if rate_limiter is None else rate_limiter
+        self.flights = SingleFlight()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate"
+        })
+
+    def get(self,
+            endpoint: str,
+            tokens: dict,
+            params: dict = None,
+            priority: int = PRIORITY_NORMAL):
+        """
+        Makes a GET request to an endpoint of the API and returns the
+        decoded JSON response. Responses of cacheable resources are served
+        from the cache while they haven't expired, the rest of requests are
+        scheduled by the rate limiter according to their priority. Identical
+        requests made concurrently with the same token, e.g. by several
+        Streamlit sessions of an athlete opening the same ride, share a
+        single call and response
+        """
+
+        if params:
+            return self._get(endpoint, tokens, params, priority)
+
+        key = _cache_key(endpoint, tokens)
+        return self.flights.do(key, self._get_cached, endpoint, tokens, key,
+                               priority)
+
+    def _get_cached(self, endpoint, tokens, key, priority):
+
+        resource = endpoint.split("/")[0]
+        if self.cache is None or not self.cache.is_cacheable(resource):
+            return self._get(endpoint, tokens, None, priority)
+
+        # the shared fields of public segments are cached for every athlete,
+        # the rest of responses only for the token that fetched them
+        is_shared = resource == "segments"
+        response = self.cache.get(endpoint, resource,
+                                  fallback=key) if is_shared else \
+            self.cache.get(key, resource)
+        increment("cache_misses" if response is None else "cache_hits")
+        if response is None:
+            response = self._get(endpoint, tokens, None, priority)
+            # error messages (rate limit, not found...) are not cached
+            if "message" not in response:
+                if is_shared and not response.get("private"):
+                    self.cache.set(endpoint, resource,
+                                   shared_segment(response))
+                else:
+                    self.cache.set(key, resource, response)
+        elif is_shared and not response.get("private"):
+            response = shared_segment(response)
+
+        return response
+
+    def _get(self, endpoint, tokens, params, priority):
+
+        # define headers for request
+        headers = {"Authorization": "Bearer {}".format(tokens["access_token"])}
+
+        resource = endpoint.split("/")[0]
+
+        with timed("fetch.rate_limit_wait"):
+            self.rate_limiter.acquire(priority)
+        response = None
+        try:
+            with timed(f"fetch.{resource}"):
+                response = self.session.get(self.base_url + endpoint,
+                                            headers=headers,
+                                            params=params,
+                                            timeout=self.timeout)
+        finally:
+            self.rate_limiter.release(
+                None if response is None else response.headers,
+                None if response is None else response.status_code)
+
+        increment("api_calls")
+        # compressed size when the server sends it
+        increment(
+            "bytes_received",
+            int(response.headers.get("Content-Length", len(response.content))))
+
+        with timed("parse.json"):
+            return response.json()
+
+    def post_token(self, data: dict):
+        """ Makes a POST request to the OAuth token endpoint """
+
+        response = self.session.post(self.oauth_url,
+                                     data=data,
+                                     timeout=self.timeout)
+
+        return response.json()
+
+
+def _cache_key(endpoint, tokens):
+    # responses may be private, so they are only shared between requests
+    # made with the same token
+    token_hash = hashlib.sha256(tokens["access_token"].encode()).hexdigest()
+    return "{}#{}".format(endpoint, token_hash[:16])
+
+
+def shared_segment(segment: dict) -> dict:
+    """ Keeps the fields of a segment that can be shared between athletes """
+
+    return {k: v for k, v in segment.items() if k in SHARED_SEGMENT_FIELDS}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> StravaClient:
+    """ Returns the client shared by all the pystrava modules """
+
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            # an empty PYSTRAVA_CACHE_PATH disables the response cache
+            cache_path = os.getenv("PYSTRAVA_CACHE_PATH", DEFAULT_CACHE_PATH)
+            cache = ResponseCache(cache_path) if cache_path else None
+            _client = StravaClient(cache=cache)
+
+    return _client
@@ -0,0 +1,270 @@
+""" Mean-maximal power and best effort curves computed from streams """
+
+import os
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from pystrava.streams import StreamStore, streams_dir
+from pystrava.utils import athlete_dir, DATA_DIR
+
+DEFAULT_CURVES_PATH = os.path.join(DATA_DIR, "all_time_curves.npz")
+
+# seconds
+DEFAULT_DURATIONS = np.array([
+    1, 2, 3, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 360, 480, 600,
+    720, 900, 1200, 1800, 2400, 3600, 5400, 7200, 10800, 14400, 18000
+])
+
+# meters
+DEFAULT_DISTANCES = np.array([
+    400, 1000, 1609.344, 5000, 10000, 20000, 21097.5, 40000, 42195, 50000,
+    80467.2, 100000, 160934.4, 200000
+])
+
+logger = logging.getLogger("pystrava")
+
+
+def curves_path(athlete_id) -> str:
+    """ File of the AllTimeCurves of an athlete """
+    return os.path.join(athlete_dir(athlete_id), "all_time_curves.npz")
+
+
+def _resample_1hz(times, values, max_gap=5):
+    """
+    Resamples a stream to one value per second, holding the last value for
+    gaps up to max_gap seconds and using 0 for longer gaps (pauses)
+    """
+
+    times = np.asarray(times, dtype="int64")
+    values = np.nan_to_num(np.asarray(values, dtype="float64"))
+    if len(times) == 0:
+        return values
+
+    seconds = np.arange(times[0], times[-1] + 1)
+    previous = np.searchsorted(times, seconds, side="right") - 1
+    resampled = values[previous]
+    resampled[seconds - times[previous] > max_gap] = 0
+
+    return resampled
+
+
+def mean_max_power(times, watts, durations=DEFAULT_DURATIONS) -> np.ndarray:
+    """
+    Highest average power held for each duration, NaN for the durations
+    longer than the activity
+    :param times: seconds since the start of each sample
+    :param watts: power of each sample
+    :param durations: durations in seconds
+    """
+
+    power = _resample_1hz(times, watts)
+    cumulative = np.concatenate([[0], np.cumsum(power)])
+
+    curve = np.full(len(durations), np.nan)
+    for i, duration in enumerate(durations):
+        if duration <= len(power):
+            window_sums = cumulative[duration:] - cumulative[:-duration]
+            curve[i] = window_sums.max() / duration
+
+    return curve
+
+
+def best_times_for_distances(times, distances,
+                             targets=DEFAULT_DISTANCES) -> np.ndarray:
+    """
+    Shortest time in seconds to cover each target distance, NaN for the
+    distances longer than the activity
+    :param times: seconds since the start of each sample
+    :param distances: distance in meters since the start of each sample
+    :param targets: distances in meters
+    """
+
+    times = np.asarray(times, dtype="float64")
+    distances = np.asarray(distances, dtype="float64")
+    valid = ~np.isnan(distances)
+    times, distances = times[valid], np.maximum.accumulate(distances[valid])
+
+    curve = np.full(len(targets), np.nan)
+    for i, target in enumerate(targets):
+        # first sample at least target meters after each sample
+        ends = np.searchsorted(distances, distances + target, side="left")
+        reached = ends < len(distances)
+        if reached.any():
+            curve[i] = (times[ends[reached]] - times[reached]).min()
+
+    return curve
+
+
+def activity_curves(records: np.ndarray,
+                    durations=DEFAULT_DURATIONS,
+                    targets=DEFAULT_DISTANCES) -> dict:
+    """ Power and best time curves of an activity from its streams """
+
+    return {
+        "power": mean_max_power(records["time"], records["watts"], durations)
+        if not np.isnan(records["watts"]).all() else np.full(
+            len(durations), np.nan),
+        "time":
+        best_times_for_distances(records["time"], records["distance"],
+                                 targets)
+    }
+
+
+def activities_curves(activity_ids,
+                      store: StreamStore = None,
+                      durations=DEFAULT_DURATIONS,
+                      targets=DEFAULT_DISTANCES):
+    """
+    Power and best time curves of several stored activities
+    :return: two dataframes with one row per activity, one with the power
+        for each duration and the other with the time for each distance
+    """
+
+    store = StreamStore() if store is None else store
+    activity_ids = [a for a in activity_ids if a in store]
+
+    curves = [
+        activity_curves(store.load(a), durations, targets)
+        for a in activity_ids
+    ]
+
+    df_power = pd.DataFrame([c["power"] for c in curves],
+                            index=activity_ids,
+                            columns=durations)
+    df_time = pd.DataFrame([c["time"] for c in curves],
+                           index=activity_ids,
+                           columns=targets)
+
+    return df_power, df_time
+
+
+class AllTimeCurves:
+    """
+    Best power and best time curves over every activity ingested so far.
+    Each new activity only updates the curves with its own bests, so the
+    history never has to be processed again
+    """
+
+    def __init__(self, durations=DEFAULT_DURATIONS, targets=DEFAULT_DISTANCES):
+        self.durations = np.asarray(durations)
+        self.targets = np.asarray(targets)
+        self.power = np.full(len(self.durations), np.nan)
+        self.power_activity = np.zeros(len(self.durations), dtype="int64")
+        self.time = np.full(len(self.targets), np.nan)
+        self.time_activity = np.zeros(len(self.targets), dtype="int64")
+        self.activity_ids = set()
+        self._lock = threading.Lock()
+
+    def update(self, activity_id, records: np.ndarray) -> bool:
+        """
+        Updates the curves with the streams of an activity, returns False
+        if the activity had already been ingested
+        """
+
+        activity_id = int(activity_id)
+        if activity_id in self.activity_ids:
+            return False
+
+        curves = activity_curves(records, self.durations, self.targets)
+
+        with self._lock:
+            better = ~(curves["power"] <= self.power) & ~np.isnan(
+                curves["power"])
+            self.power[better] = curves["power"][better]
+            self.power_activity[better] = activity_id
+
+            better = ~(curves["time"] >= self.time) & ~np.isnan(curves["time"])
+            self.time[better] = curves["time"][better]
+            self.time_activity[better] = activity_id
+
+            self.activity_ids.add(activity_id)
+
+        return True
+
+    def update_from_store(self, store: StreamStore) -> int:
+        """
+        Ingests the activities stored in the store of the athlete that
+        haven't been ingested yet and returns how many were ingested
+        """
+
+        n_updated = 0
+        for activity_id in store.activity_ids():
+            n_updated += self.update(activity_id, store.load(activity_id))
+
+        logger.info(f"Updated the all-time curves with {n_updated} "
+                    "activities.")
+
+        return n_updated
+
+    def power_curve(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "duration": self.durations,
+            "watts": self.power,
+            "activity_id": self.power_activity
+        })
+
+    def time_curve(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "distance": self.targets,
+            "time": self.time,
+            "activity_id": self.time_activity
+        })
+
+    def save(self, path: str = DEFAULT_CURVES_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        with self._lock:
+            np.savez(tmp_path,
+                     durations=self.durations,
+                     targets=self.targets,
+                     power=self.power,
+                     power_activity=self.power_activity,
+                     time=self.time,
+                     time_activity=self.time_activity,
+                     activity_ids=np.array(sorted(self.activity_ids),
+                                           dtype="int64"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CURVES_PATH):
+        """ Loads curves saved with save, empty if the file is missing """
+
+        if not os.path.exists(path):
+            return cls()
+
+        with np.load(path) as data:
+            curves = cls(data["durations"], data["targets"])
+            curves.power = data["power"]
+            curves.power_activity = data["power_activity"]
+            curves.time = data["time"]
+            curves.time_activity = data["time_activity"]
+            curves.activity_ids = set(data["activity_ids"].tolist())
+
+        return curves
+
+
+def sync_curves(activity_ids, tokens, athlete_id) -> AllTimeCurves:
+    """
+    Fetches the streams of the activities of an athlete that aren't stored
+    yet, updates the all-time curves of the athlete with them and saves the
+    curves
+    """
+
+    store = StreamStore(streams_dir(athlete_id))
+    curves = AllTimeCurves.load(curves_path(athlete_id))
+
+    store.sync(activity_ids, tokens)
+    # the activities stored before, e.g. by the app, are ingested too
+    n_updated = sum(
+        curves.update(activity_id, store.load(activity_id))
+        for activity_id in activity_ids if activity_id in store)
+
+    if n_updated:
+        curves.save(curves_path(athlete_id))
+    logger.info(f"Updated the all-time curves with {n_updated} "
+                "activities.")
+
+    return curves
@@ -0,0 +1,260 @@
+""" Persistent history of the athlete's segment efforts """
+
+import os
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from pystrava.utils import athlete_dir, DATA_DIR
+
+DEFAULT_HISTORY_PATH = os.path.join(DATA_DIR, "history.sqlite")
+
+SECONDS_PER_DAY = 86400
+
+logger = logging.getLogger("pystrava")
+
+
+def history_path(athlete_id) -> str:
+    """ File of the EffortHistory of an athlete """
+    return os.path.join(athlete_dir(athlete_id), "history.sqlite")
+
+
+class EffortHistory:
+    """
+    SQLite table with every segment effort of an athlete ingested so far,
+    see history_path, and a table of aggregates per segment (best time,
+    number of efforts, leader time and the running sums of the trend) that
+    is updated as each effort is ingested, so the history never has to be
+    scanned or fetched again
+    """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH):
+        self.path = path
+        self._local = threading.local()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS efforts (
+                effort_id INTEGER PRIMARY KEY,
+                segment_id INTEGER NOT NULL,
+                activity_id INTEGER NOT NULL,
+                start_date REAL NOT NULL,
+                elapsed_time INTEGER NOT NULL,
+                leader_time INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS efforts_segment
+                ON efforts (segment_id, start_date);
+            CREATE TABLE IF NOT EXISTS activities (
+                activity_id INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                segment_id INTEGER PRIMARY KEY,
+                name TEXT,
+                n_efforts INTEGER NOT NULL,
+                best_time INTEGER NOT NULL,
+                best_effort_id INTEGER NOT NULL,
+                best_date REAL NOT NULL,
+                first_date REAL NOT NULL,
+                last_date REAL NOT NULL,
+                leader_time INTEGER,
+                sum_t REAL NOT NULL,
+                sum_tt REAL NOT NULL,
+                sum_y REAL NOT NULL,
+                sum_ty REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS segments_gap
+                ON segments (best_time * 1.0 / leader_time);
+        """)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def __contains__(self, activity_id) -> bool:
+        return self._connection().execute(
+            "SELECT 1 FROM activities WHERE activity_id = ?",
+            (int(activity_id), )).fetchone() is not None
+
+    def add_efforts(self,
+                    df_efforts: pd.DataFrame,
+                    activity_id=None,
+                    leader_times=None) -> int:
+        """
+        Ingests segment efforts, the ones already ingested are skipped.
+        Returns how many efforts were added
+        :param df_efforts: efforts with the columns of
+            segments.SEGMENT_EFFORT_DTYPES, and optionally activity_id and
+            leader_time columns
+        :param activity_id: activity of the efforts, if there isn't an
+            activity_id column
+        :param leader_times: leader time in seconds by segment id, used if
+            there isn't a leader_time column
+        """
+
+        df = df_efforts
+        activity_ids = df["activity_id"] if "activity_id" in df else pd.Series(
+            activity_id, index=df.index)
+
+        if "leader_time" in df:
+            leader = df["leader_time"]
+        elif leader_times is not None:
+            leader_times = pd.Series(leader_times)
+            leader = df["segment.id"].map(
+                leader_times[~leader_times.index.duplicated()])
+        else:
+            leader = pd.Series(np.nan, index=df.index)
+        # unknown leader times are 0 when ranking
+        leader = leader.where(leader > 0)
+
+        dates = pd.to_datetime(df["start_date"], utc=True)
+        days = (dates - pd.Timestamp(0, tz="UTC")).dt.total_seconds() / \
+            SECONDS_PER_DAY
+
+        rows = zip(df["id"].tolist(), df["segment.id"].tolist(),
+                   df["segment.name"].tolist(), activity_ids.tolist(),
+                   days.tolist(), df["elapsed_time"].tolist(), leader.tolist())
+
+        connection = self._connection()
+        n_added = 0
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for effort_id, segment_id, name, effort_activity_id, day, \
+                    elapsed_time, leader_time in rows:
+                leader_time = None if pd.isna(leader_time) else int(
+                    leader_time)
+                added = connection.execute(
+                    "INSERT OR IGNORE INTO efforts VALUES (?, ?, ?, ?, ?, ?)",
+                    (effort_id, segment_id, int(effort_activity_id), day,
+                     elapsed_time, leader_time)).rowcount
+                if not added:
+                    continue
+                self._update_segment(connection, segment_id, name, effort_id,
+                                     day, elapsed_time, leader_time)
+                n_added += 1
+
+            connection.executemany(
+                "INSERT OR IGNORE INTO activities VALUES (?)",
+                [(int(a), ) for a in activity_ids.dropna().unique()])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        logger.info(f"Added {n_added} efforts to the history.")
+
+        return n_added
+
+    @staticmethod
+    def _update_segment(connection, segment_id, name, effort_id, day,
+                        elapsed_time, leader_time):
+        # the expressions of the update use the values before the update
+        connection.execute(
+            """INSERT INTO segments VALUES
+                   (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (segment_id) DO UPDATE SET
+                   name = COALESCE(excluded.name, name),
+                   n_efforts = n_efforts + 1,
+                   best_time = MIN(best_time, excluded.best_time),
+                   best_effort_id = CASE WHEN excluded.best_time < best_time
+                       THEN excluded.best_effort_id ELSE best_effort_id END,
+                   best_date = CASE WHEN excluded.best_time < best_time
+                       THEN excluded.best_date ELSE best_date END,
+                   first_date = MIN(first_date, excluded.first_date),
+                   last_date = MAX(last_date, excluded.last_date),
+                   leader_time = COALESCE(excluded.leader_time, leader_time),
+                   sum_t = sum_t + excluded.sum_t,
+                   sum_tt = sum_tt + excluded.sum_tt,
+                   sum_y = sum_y + excluded.sum_y,
+                   sum_ty = sum_ty + excluded.sum_ty""",
+            (segment_id, name, elapsed_time, effort_id, day, day, day,
+             leader_time, day, day * day, elapsed_time, day * elapsed_time))
+
+    def segments(self, segment_ids=None) -> pd.DataFrame:
+        """
+        Aggregates per segment: number of efforts, best time, leader time,
+        gap from the best time to the leader and trend of the elapsed time
+        in seconds per day, negative if the athlete is getting faster
+        """
+
+        query = SEGMENTS_QUERY
+        params = ()
+        if segment_ids is not None:
+            segment_ids = [int(s) for s in segment_ids]
+            query += " WHERE segment_id IN ({})".format(",".join(
+                "?" * len(segment_ids)))
+            params = segment_ids
+
+        return _to_frame(self._connection().execute(query, params))
+
+    def closest_to_leader(self, n: int = 20) -> pd.DataFrame:
+        """
+        The n segments where the best time of the athlete is closest to the
+        leader, read from the index of the gap
+        """
+
+        return _to_frame(self._connection().execute(
+            SEGMENTS_QUERY + """
+            WHERE leader_time > 0
+            ORDER BY best_time * 1.0 / leader_time
+            LIMIT ?""", (int(n), )))
+
+    def efforts(self, segment_id) -> pd.DataFrame:
+        """
+        Progression on a segment: every effort in date order with its gap to
+        the leader at the time and the best time so far
+        """
+
+        df = pd.read_sql_query(
+            """SELECT effort_id, activity_id, start_date, elapsed_time,
+                      leader_time
+               FROM efforts WHERE segment_id = ?
+               ORDER BY start_date""",
+            self._connection(),
+            params=(int(segment_id), ))
+
+        df["start_date"] = pd.to_datetime(df["start_date"] * SECONDS_PER_DAY,
+                                          unit="s",
+                                          utc=True)
+        df["difference_from_leader"] = df["elapsed_time"] / df[
+            "leader_time"] - 1
+        df["best_time"] = df["elapsed_time"].cummin()
+        df["is_pr"] = df["elapsed_time"] < df["best_time"].shift(
+            fill_value=np.inf)
+
+        return df
+
+
+SEGMENTS_QUERY = """
+    SELECT segment_id AS "segment.id", name, n_efforts, best_time,
+           best_effort_id, best_date, first_date, last_date, leader_time,
+           best_time * 1.0 / leader_time - 1 AS difference_from_leader,
+           CASE WHEN n_efforts * sum_tt - sum_t * sum_t > 0
+               THEN (n_efforts * sum_ty - sum_t * sum_y) /
+                    (n_efforts * sum_tt - sum_t * sum_t)
+           END AS trend
+    FROM segments"""
+
+
+def _to_frame(cursor) -> pd.DataFrame:
+    """ Converts the rows of SEGMENTS_QUERY to a dataframe """
+
+    df = pd.DataFrame(cursor.fetchall(),
+                      columns=[c[0] for c in cursor.description])
+    for column in ["best_date", "first_date", "last_date"]:
+        df[column] = pd.to_datetime(df[column] * SECONDS_PER_DAY,
+                                    unit="s",
+                                    utc=True)
+
+    return df
@@ -1,35 +1,56 @@
 """ Functions to create custom maps """
 
-import pydeck as pdk
 import pandas as pd
 import numpy as np
 
+from pystrava.timing import timed
 
-def create_map(df_coordinates: pd.DataFrame, map_style: str = 'light'):
+# the simplified paths keep their detail up to this many zoom levels
+# closer than the initial view of the map
+DETAIL_ZOOM_LEVELS = 2
+
+MAP_STYLES = {
+    'light': "light-v9",
+    'dark': "dark-v10",
+    'streets': "streets-v11",
+    'outdoors': "outdoors-v11",
+    'satellite': "satellite-streets-v11"
+}
+
+
+@timed("render.create_map")
+def create_map(df_coordinates: pd.DataFrame,
+               map_style: str = 'light',
+               tolerance_px: float = 0.5):
     """
     :param df_coordinates: dataframe containing longitudes and latitudes
     :param map_style: string that defines MapBox style, can be light, dark, streets, outdoors, satellite
+    :param tolerance_px: maximum deviation in pixels of the simplified path
+        after zooming in DETAIL_ZOOM_LEVELS from the initial view, 0 sends
+        the path at full resolution
     :return: Deck object
     """
 
-    lats = df_coordinates['latitude']
-    lons = df_coordinates['longitude']
+    # pydeck is imported on first use, so importing the module is cheap
+    import pydeck as pdk
+
+    lats = df_coordinates['latitude'].to_numpy(dtype="float64")
+    lons = df_coordinates['longitude'].to_numpy(dtype="float64")
     centroide = _get_centroid(lats, lons)
     zoom = _get_zoom_level(lats, lons)
 
-    df_coordinates['points'] = [
-        [x, y] for x, y in zip(  # <-- Points have to be Lon/Lat !!!!!
-            df_coordinates.longitude, df_coordinates.latitude)
-    ]
-
-    flat_list = []
-    for p in df_coordinates['points']:
-        flat_list.append(p)
+    # Points have to be Lon/Lat !!!!!
+    path = np.column_stack([lons, lats])
+    if tolerance_px > 0:
+        path = _simplify_path(
+            path,
+            _get_tolerance(zoom + DETAIL_ZOOM_LEVELS, tolerance_px),
+            centroide['lat'])
 
     df_path = pd.DataFrame({
         'name': 'Strava Activity',
         'color': '#ed1c24',
-        'path': [flat_list]
+        'path': [path.tolist()]
     })
 
     def hex_to_rgb(h):
@@ -55,16 +76,8 @@ def create_map(df_coordinates: pd.DataFrame, map_style: str = 'light'):
         )
     ]
 
-    map_style_dict = {
-        'light': "light-v9",
-        'dark': "dark-v10",
-        'streets': "streets-v11",
-        'outdoors': "outdoors-v11",
-        'satellite': "satellite-streets-v11"
-    }
-
     r = pdk.Deck(map_style="mapbox://styles/mapbox/{}".format(
-        map_style_dict[map_style]),
+        MAP_STYLES[map_style]),
                  layers=layers,
                  initial_view_state=view_state,
                  tooltip={"text": "{name}"})
@@ -72,9 +85,128 @@ def create_map(df_coordinates: pd.DataFrame, map_style: str = 'light'):
     return (r)
 
 
+@timed("render.create_heatmap")
+def create_heatmap(activities_coordinates,
+                   map_style: str = 'dark',
+                   cell_size_px: float = 4):
+    """
+    Creates a density map of many activities. The paths are binned into a
+    grid on the server and only the occupied cells are sent to the browser,
+    so the payload depends on the area covered and not on the number of
+    activities or points
+    :param activities_coordinates: list with the coordinates of each
+        activity, as dataframes with latitude and longitude columns or
+        arrays of (latitude, longitude) rows
+    :param map_style: string that defines MapBox style, can be light, dark, streets, outdoors, satellite
+    :param cell_size_px: size of the grid cells in pixels at the zoom level
+        of the initial view, which bounds the number of cells sent
+    :return: Deck object
+    """
+
+    import pydeck as pdk
+
+    paths = [
+        c[['latitude', 'longitude']].to_numpy(dtype="float64") if isinstance(
+            c, pd.DataFrame) else np.asarray(c, dtype="float64").reshape(-1, 2)
+        for c in activities_coordinates
+    ]
+    paths = [p for p in paths if len(p) > 0]
+
+    # no activity with coordinates yet, e.g. a fresh history
+    if not paths:
+        return pdk.Deck(map_style="mapbox://styles/mapbox/{}".format(
+            MAP_STYLES[map_style]),
+                        layers=[],
+                        initial_view_state=pdk.ViewState(latitude=0,
+                                                         longitude=0,
+                                                         zoom=1))
+
+    all_points = np.concatenate(paths)
+    lats, lons = all_points[:, 0], all_points[:, 1]
+    centroide = _get_centroid(lats, lons)
+    zoom = _get_zoom_level(lats, lons)
+
+    df_cells = _bin_paths(paths,
+                          _get_tolerance(zoom, cell_size_px),
+                          centroide['lat'])
+
+    view_state = pdk.ViewState(latitude=centroide['lat'],
+                               longitude=centroide['lon'],
+                               zoom=zoom)
+
+    layers = [
+        pdk.Layer(
+            type="HeatmapLayer",
+            data=df_cells,
+            get_position=["longitude", "latitude"],
+            get_weight="activities",
+            aggregation="SUM",
+            radius_pixels=cell_size_px * 4,
+        )
+    ]
+
+    r = pdk.Deck(map_style="mapbox://styles/mapbox/{}".format(
+        MAP_STYLES[map_style]),
+                 layers=layers,
+                 initial_view_state=view_state)
+
+    return (r)
+
+
+def _bin_paths(paths, cell_size: float, lat: float = 0) -> pd.DataFrame:
+    """
+    Counts how many paths go through each cell of a grid
+    :param paths: list of arrays of (latitude, longitude) rows
+    :param cell_size: width of the cells in degrees of longitude, the
+        height is scaled by cos(lat) so the cells are square on screen
+    :param lat: latitude of the paths
+    :return: dataframe with the center of each cell that is crossed by
+        any path and the number of paths that cross it
+    """
+
+    cell = np.array([cell_size * np.cos(np.radians(lat)), cell_size])
+
+    cells = []
+    for path in paths:
+        # fill the gaps between distant points so the path crosses
+        # every cell on its way
+        points = _densify(path, cell)
+        keys = np.floor(points / cell).astype("int64")
+        # each path counts once per cell
+        cells.append(np.unique(keys, axis=0))
+
+    keys, counts = np.unique(np.concatenate(cells), axis=0, return_counts=True)
+    centers = (keys + 0.5) * cell
+
+    return pd.DataFrame({
+        'latitude': np.round(centers[:, 0], 6),
+        'longitude': np.round(centers[:, 1], 6),
+        'activities': counts
+    })
+
+
+def _densify(points: np.array, step: np.array):
+    """ Adds points along each leg of a path so they are at most step apart """
+
+    if len(points) < 2:
+        return points
+
+    legs = np.diff(points, axis=0)
+    n_steps = np.maximum(
+        np.ceil(np.abs(legs / step).max(axis=1)).astype("int64"), 1)
+
+    leg_index = np.repeat(np.arange(len(legs)), n_steps)
+    first_step = np.repeat(np.cumsum(n_steps) - n_steps, n_steps)
+    fraction = (np.arange(n_steps.sum()) - first_step) / n_steps[leg_index]
+
+    dense = points[leg_index] + legs[leg_index] * fraction[:, None]
+
+    return np.vstack([dense, points[-1:]])
+
+
 def _get_centroid(lats: np.array, lons: np.array):
-    maxlon, minlon = max(lons), min(lons)
-    maxlat, minlat = max(lats), min(lats)
+    maxlon, minlon = np.max(lons), np.min(lons)
+    maxlat, minlat = np.max(lats), np.min(lats)
     center = {
         'lon': round((maxlon + minlon) / 2, 6),
         'lat': round((maxlat + minlat) / 2, 6)
@@ -91,7 +223,7 @@ def _get_zoom_level(lats: np.array, lons: np.array):
     :return: zoom level to fit bounds in the map
     """
 
-    bounds = [max(lats), max(lons), min(lats), min(lons)]
+    bounds = [np.max(lats), np.max(lons), np.min(lats), np.min(lons)]
 
     ne_lat = bounds[0]
     ne_long = bounds[1]
@@ -121,3 +253,57 @@ def _get_zoom_level(lats: np.array, lons: np.array):
     lngZoom = zoom(mapDim['width'], WORLD_DIM['width'], lngFraction)
 
     return min(latZoom, lngZoom, ZOOM_MAX)
+
+
+def _get_tolerance(zoom: float, tolerance_px: float):
+    """
+    Converts a distance in pixels at a zoom level to degrees of longitude,
+    the tile size of 256 pixels is the one used by _get_zoom_level
+    """
+    return tolerance_px * 360 / (256 * 2**zoom)
+
+
+def _simplify_path(points: np.array, tolerance: float, lat: float = 0):
+    """
+    Simplifies a path with the Douglas-Peucker algorithm
+    :param points: array of shape (n, 2) with longitudes and latitudes
+    :param tolerance: maximum deviation in degrees of longitude
+    :param lat: latitude of the path, used to scale the latitudes the way
+        the Mercator projection does
+    :return: array with the points of the simplified path
+    """
+
+    n_points = len(points)
+    if n_points < 3:
+        return points
+
+    # on screen, a degree of latitude is 1 / cos(lat) times a degree of
+    # longitude
+    xy = points * np.array([1, 1 / np.cos(np.radians(lat))])
+
+    keep = np.zeros(n_points, dtype=bool)
+    keep[[0, -1]] = True
+
+    stack = [(0, n_points - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        inner = xy[start + 1:end] - xy[start]
+        dx, dy = xy[end] - xy[start]
+        norm = np.hypot(dx, dy)
+
+        # distance of the inner points to the line from start to end
+        if norm == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(dx * inner[:, 1] - dy * inner[:, 0]) / norm
+
+        farthest = np.argmax(distances)
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+
+    return points[keep]
@@ -0,0 +1,242 @@
+""" Offline matching of segment efforts against stored GPS tracks """
+
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pystrava.client import get_client, shared_segment
+from pystrava.segments import _get_secs, _rank_segments
+from pystrava.spatial import GridIndex, haversine_km
+from pystrava.streams import StreamStore
+from pystrava.transformations import decode_polyline
+
+logger = logging.getLogger("pystrava")
+
+
+class SegmentMatcher:
+    """
+    Detects the segments ridden in a GPS track without calling the API.
+    The start points of the known segments are kept in a grid index, so
+    only the segments that start near the track are checked
+    """
+
+    def __init__(self,
+                 radius_km: float = 0.025,
+                 tolerance_km: float = 0.05,
+                 n_checkpoints: int = 20,
+                 cell_size_km: float = 0.5):
+        """
+        :param radius_km: maximum distance from the track to the start and
+            end points of a segment
+        :param tolerance_km: maximum distance from the track to the rest of
+            the points of the segment
+        :param n_checkpoints: number of points of the segment checked
+        :param cell_size_km: size of the cells of the grid index
+        """
+        self.radius_km = radius_km
+        self.tolerance_km = tolerance_km
+        self.n_checkpoints = n_checkpoints
+        self.index = GridIndex(cell_size_km)
+        self.segments = {}
+        self.details = {}
+
+    def add_segment(self, segment_id, coordinates, details: dict = None):
+        """
+        :param segment_id: id of the segment
+        :param coordinates: array of (latitude, longitude) rows, e.g. the
+            result of transformations.get_segment_coordinates
+        :param details: segment representation returned by the API
+        """
+
+        coordinates = np.asarray(coordinates, dtype="float64").reshape(-1, 2)
+        if len(coordinates) < 2:
+            return
+
+        segment_id = int(segment_id)
+        if segment_id not in self.segments:
+            self.index.insert(segment_id, *coordinates[0])
+        self.segments[segment_id] = coordinates
+        if details is not None:
+            self.details[segment_id] = details
+
+    @classmethod
+    def from_cache(cls, cache=None, **kwargs):
+        """ Creates a matcher with every segment in the response cache """
+
+        cache = get_client().cache if cache is None else cache
+        matcher = cls(**kwargs)
+        if cache is None:
+            return matcher
+
+        # only the shared segments, without the fields of other athletes
+        for key, segment in cache.items("segments"):
+            polyline = segment.get("map", {}).get("polyline")
+            if re.fullmatch(r"segments/\d+", key) and polyline:
+                matcher.add_segment(segment["id"], decode_polyline(polyline),
+                                    shared_segment(segment))
+
+        logger.info(f"Loaded {len(matcher.segments)} segments from the cache.")
+
+        return matcher
+
+    def match(self, lats, lngs, times) -> pd.DataFrame:
+        """
+        Finds the efforts on the known segments in a track
+        :param lats: latitudes of the track
+        :param lngs: longitudes of the track
+        :param times: seconds since the start of each sample of the track
+        :return: dataframe with the segment.id, start_index, end_index and
+            elapsed_time of each effort
+        """
+
+        lats = np.asarray(lats, dtype="float64")
+        lngs = np.asarray(lngs, dtype="float64")
+        times = np.asarray(times, dtype="float64")
+
+        valid = ~(np.isnan(lats) | np.isnan(lngs))
+        candidates = self.index.query_cells(lats[valid], lngs[valid],
+                                            self.radius_km)
+
+        efforts = []
+        for segment_id in candidates:
+            for start, end in self._match_segment(self.segments[segment_id],
+                                                  lats, lngs):
+                efforts.append({
+                    "segment.id": segment_id,
+                    "start_index": start,
+                    "end_index": end,
+                    "elapsed_time": int(times[end] - times[start])
+                })
+
+        return pd.DataFrame(efforts,
+                            columns=[
+                                "segment.id", "start_index", "end_index",
+                                "elapsed_time"
+                            ]).sort_values("start_index",
+                                           ignore_index=True)
+
+    def _match_segment(self, segment, lats, lngs):
+        """ Yields the (start, end) indexes of the efforts on a segment """
+
+        starts = _closest_passes(
+            haversine_km(lats, lngs, *segment[0]), self.radius_km)
+        ends = _closest_passes(
+            haversine_km(lats, lngs, *segment[-1]), self.radius_km)
+        if len(starts) == 0 or len(ends) == 0:
+            return
+
+        checkpoints = segment[np.linspace(0,
+                                          len(segment) - 1,
+                                          self.n_checkpoints).astype(int)]
+
+        last_end = -1
+        for start in starts:
+            if start <= last_end:
+                continue
+            following = ends[ends > start]
+            if len(following) == 0:
+                break
+            end = following[0]
+
+            # every checkpoint of the segment has to be close to the track
+            distances = haversine_km(lats[start:end + 1, None],
+                                     lngs[start:end + 1, None],
+                                     checkpoints[None, :, 0],
+                                     checkpoints[None, :, 1])
+            if np.nanmin(distances, axis=0).max() <= self.tolerance_km:
+                last_end = end
+                yield int(start), int(end)
+
+
+def _closest_passes(distances, radius_km):
+    """
+    Returns the index of the closest point of each pass of the track
+    within radius_km of a point
+    """
+
+    near = distances <= radius_km
+    if not near.any():
+        return np.array([], dtype="int64")
+
+    # passes are runs of consecutive points within the radius
+    edges = np.diff(near.astype("int8"), prepend=0, append=0)
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    return np.array([
+        start + np.argmin(distances[start:end])
+        for start, end in zip(run_starts, run_ends)
+    ],
+                    dtype="int64")
+
+
+def match_activities(activity_ids, matcher: SegmentMatcher,
+                     store: StreamStore = None) -> pd.DataFrame:
+    """
+    Matches the stored streams of several activities against the known
+    segments, the activities without stored streams are skipped
+    """
+
+    store = StreamStore() if store is None else store
+
+    frames = []
+    for activity_id in activity_ids:
+        if activity_id not in store:
+            continue
+        records = store.load(activity_id)
+        df = matcher.match(records["lat"], records["lng"], records["time"])
+
+        # distance covered during the effort, if the track has distances
+        distances = np.asarray(records["distance"])
+        df["distance"] = distances[df["end_index"].to_numpy(
+            dtype="int64")] - distances[df["start_index"].to_numpy(
+                dtype="int64")]
+        df["activity_id"] = activity_id
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def rank_matched_efforts(df_efforts: pd.DataFrame, matcher: SegmentMatcher,
+                         gender) -> pd.DataFrame:
+    """
+    Ranks efforts found by the matcher like sort_segments_from_activity
+    does, using the segment details and leader times of the matcher so no
+    request is made. Segments without details are dropped
+    :param df_efforts: efforts returned by match_activities or
+        SegmentMatcher.match, without a distance column the efforts cover
+        the distance of their segment
+    """
+
+    if "segment.id" not in df_efforts:
+        return pd.DataFrame()
+
+    df_efforts = df_efforts[df_efforts["segment.id"].isin(
+        matcher.details)].copy()
+    if df_efforts.empty:
+        return pd.DataFrame()
+
+    details = pd.json_normalize(
+        [matcher.details[i] for i in df_efforts["segment.id"]]).add_prefix(
+            "segment.")
+    details.index = df_efforts.index
+    df_efforts = df_efforts.join(details.drop(columns="segment.id"))
+
+    df_efforts["name"] = df_efforts["segment.name"]
+    df_efforts["pr_rank"] = np.nan
+    # without distance streams, the effort covers the segment distance
+    if "distance" not in df_efforts:
+        df_efforts["distance"] = np.nan
+    df_efforts["distance"] = df_efforts["distance"].fillna(
+        df_efforts["segment.distance"])
+
+    xom = "segment.xoms.qom" if gender == 'women' else "segment.xoms.kom"
+    leader_times = _get_secs(df_efforts[xom] if xom in df_efforts else [None] *
+                             len(df_efforts))
+
+    return _rank_segments(df_efforts, leader_times.values)
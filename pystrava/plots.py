@@ -2,34 +2,150 @@
 
 import logging
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
+
+from pystrava.timing import timed
+
+# above this number of points the scatter plots are drawn with WebGL
+WEBGL_THRESHOLD = 1000
+
+# above this number of points the scatter plots are downsampled
+MAX_POINTS = 5000
 
 logger = logging.getLogger("pystrava")
 
 
-def plot_segments_insights(data, y, ylabel, title=None):
+@timed("render.plot_segments_insights")
+def plot_segments_insights(data,
+                           y,
+                           ylabel,
+                           title=None,
+                           max_points=MAX_POINTS,
+                           webgl_threshold=WEBGL_THRESHOLD):
+    """
+    :param data: ranked segment efforts, it isn't modified
+    :param y: column plotted against the difference from the leader
+    :param ylabel: label of the y axis
+    :param title: title of the figure
+    :param max_points: the efforts are downsampled above this number
+    :param webgl_threshold: WebGL is used above this number of points
+    :return: plotly Figure
+    """
 
-    if y == "elapsed_time":
-        data['elapsed_time'] = pd.to_datetime(data['elapsed_time'])
-
-    # elif y == "segment.distance":
-    #     data["segment.distance"] = np.round(data["segment.distance"] / 1000, 2)
-
-    fig = px.scatter(data,
-                     x="difference_from_leader",
-                     y=y,
-                     color='terrain',
-                     labels={
-                         "difference_from_leader":
-                         "Percent Difference from Leader",
-                         y: ylabel,
-                         "terrain": "Terrain type"
-                     },
-                     title=title,
-                     hover_data=["name"])
-    fig.update_xaxes(range=[0, min(2, max(data["difference_from_leader"]))],
-                     tickformat='%')
+    return _scatter(prepare_insights_data(data, [y]), y, ylabel, title,
+                    max_points, webgl_threshold)
+
+
+@timed("render.plot_insights")
+def plot_insights(data,
+                  insights,
+                  max_points=MAX_POINTS,
+                  webgl_threshold=WEBGL_THRESHOLD) -> list:
+    """
+    Builds several insight plots, the data shared by all of them is
+    prepared once
+    :param data: ranked segment efforts, it isn't modified
+    :param insights: list of (y, ylabel) or (y, ylabel, title)
+    :return: list of plotly Figures
+    """
+
+    df = prepare_insights_data(data, [insight[0] for insight in insights])
+
+    figures = []
+    for y, ylabel, *title in insights:
+        figures.append(
+            _scatter(df, y, ylabel, title[0] if title else None, max_points,
+                     webgl_threshold))
+
+    return figures
+
+
+def prepare_insights_data(data, ys) -> pd.DataFrame:
+    """
+    Copies only the columns used by the plots, with the elapsed time
+    converted for display
+    """
+
+    columns = list(
+        dict.fromkeys(["difference_from_leader", "terrain", "name", *ys]))
+    df = data[columns].copy()
+
+    if "elapsed_time" in ys:
+        # elapsed time is in seconds, it's formatted only for display
+        df["elapsed_time"] = pd.to_datetime(df["elapsed_time"], unit='s')
+
+    return df
+
+
+def _downsample(df, y, max_points):
+    """
+    Keeps a single effort per terrain in each cell of a grid over the
+    plotted area, so dense clouds are thinned out but isolated efforts
+    (the interesting ones) are kept
+    """
+
+    if len(df) <= max_points:
+        return df
+
+    n_terrains = max(df["terrain"].nunique(), 1)
+    n_bins = max(int(np.sqrt(max_points / n_terrains)), 1)
+
+    x = df["difference_from_leader"].clip(0, 2).to_numpy(dtype="float64")
+    values = df[y]
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.astype("int64")
+    values = values.to_numpy(dtype="float64")
+
+    cells = pd.DataFrame({
+        "terrain": df["terrain"].to_numpy(),
+        "x": _bin(x, n_bins),
+        "y": _bin(values, n_bins)
+    })
+
+    return df[~cells.duplicated().to_numpy()]
+
+
+def _bin(values, n_bins):
+    """ Index of the equal width bin of each value, -1 for NaN """
+
+    finite = np.isfinite(values)
+    if not finite.any():
+        return np.full(len(values), -1)
+
+    low, high = values[finite].min(), values[finite].max()
+    width = (high - low) / n_bins or 1
+    bins = np.minimum((values - low) // width, n_bins - 1)
+
+    return np.where(finite, bins, -1).astype("int64")
+
+
+def _scatter(df, y, ylabel, title, max_points, webgl_threshold):
+
+    # plotly is imported on first use, so importing the module is cheap
+    import plotly.express as px
+
+    x_max = min(2, df["difference_from_leader"].max())
+
+    n_efforts = len(df)
+    df = _downsample(df, y, max_points)
+    if len(df) < n_efforts:
+        logger.info(f"Plotting {len(df)} of {n_efforts} efforts of {y}.")
+
+    fig = px.scatter(
+        df,
+        x="difference_from_leader",
+        y=y,
+        color='terrain',
+        labels={
+            "difference_from_leader": "Percent Difference from Leader",
+            y: ylabel,
+            "terrain": "Terrain type"
+        },
+        title=title,
+        hover_data=["name"],
+        render_mode="webgl" if len(df) > webgl_threshold else "svg")
+    fig.update_xaxes(range=[0, x_max], tickformat='%')
 
     if y == "elapsed_time":
         fig.update_yaxes(tickformat="%H:%M:%S")
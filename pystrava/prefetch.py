@@ -0,0 +1,109 @@
+""" Background prefetch of the maps of segments """
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pystrava.maps import create_map
+from pystrava.ratelimit import PRIORITY_HIGH, PRIORITY_LOW
+from pystrava.transformations import get_segment_coordinates
+
+logger = logging.getLogger("pystrava")
+
+
+class SegmentMapPrefetcher:
+    """
+    Fetches and decodes the polylines of segments and builds their maps in
+    a bounded pool of threads, so they are ready before they are selected.
+    Segments are public, so the maps are shared by every session. Only the
+    max_entries most recently used segments are kept
+    """
+
+    def __init__(self,
+                 max_workers: int = 4,
+                 max_entries: int = 256,
+                 map_style: str = 'outdoors'):
+        """
+        :param max_workers: number of segments prepared concurrently
+        :param max_entries: number of segments kept
+        :param map_style: MapBox style of the maps, see maps.create_map
+        """
+        self.max_entries = max_entries
+        self.map_style = map_style
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pystrava-prefetch")
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, segment_ids, tokens, n: int = 10) -> int:
+        """
+        Prepares the first n segments in the background, with a lower
+        priority than the interactive requests. Returns how many were
+        submitted
+        """
+
+        segment_ids = list(dict.fromkeys(int(s) for s in segment_ids))[:n]
+
+        n_submitted = 0
+        with self._lock:
+            for segment_id in segment_ids:
+                if segment_id in self._futures:
+                    continue
+                self._futures[segment_id] = self._executor.submit(
+                    self._build, segment_id, tokens, PRIORITY_LOW)
+                n_submitted += 1
+            self._evict()
+
+        logger.info(f"Prefetching the maps of {n_submitted} segments.")
+
+        return n_submitted
+
+    def get(self, segment_id, tokens):
+        """
+        Returns the coordinates and the map of a segment, waiting for it if
+        it's being prepared and preparing it now if it wasn't prefetched
+        :return: (dataframe of coordinates, Deck object)
+        """
+
+        segment_id = int(segment_id)
+        with self._lock:
+            future = self._futures.get(segment_id)
+            if future is not None:
+                self._futures.move_to_end(segment_id)
+
+        # a queued prefetch would wait for the ones before it
+        if future is not None and not future.cancel():
+            try:
+                return future.result()
+            except Exception as e:
+                logger.info(f"Couldn't prefetch segment {segment_id}: {e}")
+
+        result = self._build(segment_id, tokens, PRIORITY_HIGH)
+
+        with self._lock:
+            self._futures[segment_id] = _done(result)
+            self._evict()
+
+        return result
+
+    def _build(self, segment_id, tokens, priority):
+        df_coordinates = get_segment_coordinates(str(segment_id),
+                                                 tokens,
+                                                 priority=priority)
+        return df_coordinates, create_map(df_coordinates, self.map_style)
+
+    def _evict(self):
+        while len(self._futures) > self.max_entries:
+            self._futures.popitem(last=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def _done(result):
+    """ Future that is already resolved with result """
+
+    future = Future()
+    future.set_result(result)
+    return future
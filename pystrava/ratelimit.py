@@ -0,0 +1,159 @@
+""" Scheduling of the requests to stay under the Strava rate limits """
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+# requests with a lower value go first when the budget is scarce
+PRIORITY_HIGH = 0  # data displayed straight away, e.g. maps
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # background lookups, e.g. leader times
+
+SHORT_WINDOW = 15 * 60  # the short limit resets every quarter of an hour
+LONG_WINDOW = 24 * 3600  # the long limit resets at midnight UTC
+
+logger = logging.getLogger("pystrava")
+
+
+class RateLimitExceeded(Exception):
+    """ Raised when a request can't be made without exceeding the limits """
+
+
+class RateLimiter:
+    """
+    Keeps track of the 15-minute and daily budgets reported by Strava in
+    the X-RateLimit-Limit and X-RateLimit-Usage headers. Requests wait in
+    a priority queue until both budgets have room for them, and the last
+    requests of each window are reserved for the most urgent priorities
+    """
+
+    def __init__(self,
+                 short_limit: int = 100,
+                 long_limit: int = 1000,
+                 reserved_fraction: float = 0.1,
+                 max_wait: float = 60):
+        """
+        :param short_limit: requests per 15 minutes until Strava reports it
+        :param long_limit: requests per day until Strava reports it
+        :param reserved_fraction: fraction of each budget that requests with
+            lower priority than PRIORITY_HIGH can't use
+        :param max_wait: maximum seconds a request waits for the budget to
+            reset before RateLimitExceeded is raised
+        """
+        self.limits = [short_limit, long_limit]
+        self.usage = [0, 0]
+        self.reserved_fraction = reserved_fraction
+        self.max_wait = max_wait
+
+        self._windows = self._current_windows()
+        self._in_flight = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def _current_windows(now=None):
+        now = time.time() if now is None else now
+        return [int(now // SHORT_WINDOW), int(now // LONG_WINDOW)]
+
+    @staticmethod
+    def _seconds_to_reset(window_size, now=None):
+        now = time.time() if now is None else now
+        return window_size - now % window_size
+
+    def _roll_windows(self):
+        windows = self._current_windows()
+        for i in range(2):
+            if windows[i] != self._windows[i]:
+                self.usage[i] = 0
+        self._windows = windows
+
+    def _wait_time(self, priority):
+        """ Seconds until a request of this priority fits in the budgets """
+
+        reserved = 0 if priority <= PRIORITY_HIGH else self.reserved_fraction
+
+        wait = 0.0
+        for i, window_size in enumerate([SHORT_WINDOW, LONG_WINDOW]):
+            budget = self.limits[i] * (1 - reserved)
+            if self.usage[i] + self._in_flight >= budget:
+                if self.usage[i] >= budget:
+                    wait = max(wait, self._seconds_to_reset(window_size))
+                else:
+                    # wait for in-flight requests to report the usage
+                    wait = max(wait, 0.1)
+        return wait
+
+    def acquire(self, priority: int = PRIORITY_NORMAL):
+        """ Blocks until the request can be made without exceeding limits """
+
+        entry = (priority, next(self._counter))
+
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    self._roll_windows()
+                    wait = self._wait_time(priority)
+
+                    if self._queue[0] == entry and wait == 0:
+                        self._in_flight += 1
+                        return
+
+                    if wait > self.max_wait:
+                        raise RateLimitExceeded(
+                            "Reached the Strava requests limit, it resets "
+                            f"in {wait:.0f} seconds")
+
+                    self._condition.wait(timeout=wait or None)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+
+    def release(self, headers: dict = None, status_code: int = None):
+        """
+        Records a finished request and updates the budgets from the rate
+        limit headers of its response
+        """
+
+        with self._condition:
+            self._in_flight -= 1
+            self._roll_windows()
+            self.usage = [usage + 1 for usage in self.usage]
+
+            if headers:
+                limits = _parse_header(headers.get("X-RateLimit-Limit"))
+                usage = _parse_header(headers.get("X-RateLimit-Usage"))
+                if limits:
+                    self.limits = limits
+                if usage:
+                    # other processes share the budget, so the usage
+                    # reported by Strava wins if it's higher
+                    self.usage = [max(u, v) for u, v in zip(self.usage, usage)]
+
+            if status_code == 429:
+                logger.info("Reached the Strava requests limit")
+                self.usage = list(self.limits)
+
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            self._roll_windows()
+            return {
+                "limits": list(self.limits),
+                "usage": list(self.usage),
+                "in_flight": self._in_flight,
+                "queued": len(self._queue)
+            }
+
+
+def _parse_header(value):
+    # headers look like "100,1000" for the 15-minute and daily values
+    try:
+        return [int(v) for v in value.split(",")][:2]
+    except (AttributeError, ValueError):
+        return None
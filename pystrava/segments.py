@@ -1,28 +1,82 @@
 """ Functions for segments analysis """
 
-import requests
-import re
+import time
 import logging
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
+from pystrava.activities import get_activity
+from pystrava.client import get_client
+from pystrava.ratelimit import PRIORITY_LOW, RateLimitExceeded
 from pystrava.utils import check_rate_limit_exceeded
+from pystrava.timing import timed, propagate
+
+# columns kept from the segment efforts and their types
+SEGMENT_EFFORT_DTYPES = {
+    "id": "int64",
+    "name": "string",
+    "start_date": "datetime64[ns, UTC]",
+    "elapsed_time": "int32",
+    "moving_time": "int32",
+    "distance": "float32",
+    "start_index": "int32",
+    "end_index": "int32",
+    "average_watts": "float32",
+    "pr_rank": "float32",
+    "segment.id": "int64",
+    "segment.name": "string",
+    "segment.activity_type": "category",
+    "segment.distance": "float32",
+    "segment.average_grade": "float32",
+    "segment.elevation_high": "float32",
+    "segment.elevation_low": "float32",
+    "segment.climb_category": "int8",
+    "segment.city": "category",
+    "segment.start_latlng": "object",
+    "segment.end_latlng": "object",
+}
+
+TERRAINS = ['uphill', 'downhill', 'flat', 'other']
 
 logger = logging.getLogger("pystrava")
 
 
+@timed("rank.sort_segments")
 def sort_segments_from_activity(tokens,
                                 activity_id,
                                 gender,
                                 filter_type,
-                                pr_filter=None):
+                                pr_filter=None,
+                                max_workers=8,
+                                activity=None):
 
     # get segments from activity
-    df_segments = _get_segments_from_activity(activity_id, tokens)
+    df_segments = _get_segments_from_activity(activity_id,
+                                              tokens,
+                                              activity=activity)
     logger.info(f"The activity contains {df_segments.shape[0]} segments.")
 
+    df_segments = _select_segments(df_segments, filter_type, pr_filter)
+    logger.info(f"There are {df_segments.shape[0]} segments selected.")
+
+    # calculate delta from leader
+    logger.info("Sorting segments...")
+    leader_times = _get_leader_times(df_segments["segment.id"],
+                                     gender=gender,
+                                     tokens=tokens,
+                                     max_workers=max_workers)
+    df_segments = _rank_segments(df_segments, leader_times)
+
+    logger.info("Sorting segments...done!")
+
+    return df_segments
+
+
+def _select_segments(df_segments, filter_type, pr_filter=None):
+    """ Selects the segments to rank according to the filters """
+
     # check the number of climb segments
     n_segments_climb = (df_segments['segment.climb_category'] > 0).sum()
 
@@ -31,20 +85,24 @@ def sort_segments_from_activity(tokens,
             'segment.activity_type'].value_counts().index[0] == 'Ride':
         df_segments = df_segments[df_segments['segment.climb_category'] > 0]
     else:
-        df_segments = df_segments.sample(n=30)
+        df_segments = df_segments.sample(n=min(30, len(df_segments)))
 
     # filter by PR (3, 2, 1)
     if pr_filter in [1, 2, 3]:
         df_segments = df_segments[df_segments['pr_rank'] <= pr_filter]
 
-    logger.info(f"There are {df_segments.shape[0]} segments selected.")
+    return df_segments
 
-    # calculate delta from leader
-    logger.info("Sorting segments...")
-    df_segments["leader_time"] = df_segments.apply(
-        lambda x: _get_time_from_leader(
-            x["segment.id"], gender=gender, tokens=tokens),
-        axis=1)
+
+@timed("rank.rank_segments")
+def _rank_segments(df_segments, leader_times):
+    """
+    Adds the leader time and the derived metrics to the segment efforts
+    and sorts them by the difference from the leader
+    """
+
+    df_segments = df_segments.copy()
+    df_segments["leader_time"] = np.asarray(leader_times)
 
     # time delta
     df_segments["difference_from_leader"] = df_segments[
@@ -59,12 +117,6 @@ def sort_segments_from_activity(tokens,
     df_segments['leader_speed'] = df_segments['distance'] / (
         df_segments['leader_time'] / 3600)
 
-    # time format
-    df_segments['elapsed_time'] = df_segments['elapsed_time'].apply(
-        lambda x: str(timedelta(seconds=x)))
-    df_segments['leader_time'] = df_segments['leader_time'].apply(
-        lambda x: str(timedelta(seconds=x)))
-
     # sort dataframe
     df_segments.sort_values(by=['difference_from_leader'], inplace=True)
 
@@ -77,11 +129,10 @@ def sort_segments_from_activity(tokens,
           df_segments['segment.elevation_low']))
 
     # calculate type of terrain
-    df_segments['terrain'] = df_segments.apply(lambda x: calculate_terrain(
-        grade=x['segment.average_grade'], elv_diff=x['elevation_difference']),
-                                               axis=1)
-
-    logger.info("Sorting segments...done!")
+    with timed("rank.terrain"):
+        terrains = calculate_terrains(df_segments['segment.average_grade'],
+                                      df_segments['elevation_difference'])
+        df_segments['terrain'] = pd.Categorical(terrains, categories=TERRAINS)
 
     return df_segments
 
@@ -94,6 +145,12 @@ def format_segments_table(df_segments):
         'leader_time', 'difference_from_leader', 'speed', 'leader_speed'
     ]].reset_index(drop=True)
 
+    # time format
+    df_segments_formatted['elapsed_time'] = _format_seconds(
+        df_segments_formatted['elapsed_time'])
+    df_segments_formatted['leader_time'] = _format_seconds(
+        df_segments_formatted['leader_time'])
+
     # rename columns
     df_segments_formatted = df_segments_formatted.rename(
         columns={
@@ -125,74 +182,146 @@ def format_segments_table(df_segments):
     return df_segments_formatted
 
 
-def _get_segments_from_activity(activity_id, tokens):
+def _get_segments_from_activity(activity_id, tokens, activity=None):
 
-    logger.info("Loading segments...")
+    # reuse the activity if it has already been fetched
+    req = get_activity(activity_id, tokens) if activity is None else activity
 
-    # store URL for activities endpoint
-    base_url = "https://www.strava.com/api/v3/"
-    endpoint = "activities/{}".format(activity_id)
-    url = base_url + endpoint
+    return efforts_to_frame(req['segment_efforts'])
 
-    # define headers and parameters for request
-    headers = {"Authorization": "Bearer {}".format(tokens["access_token"])}
 
-    # make GET request to Strava API
-    req = requests.get(url, headers=headers).json()
+@timed("parse.segment_efforts")
+def efforts_to_frame(efforts) -> pd.DataFrame:
+    """
+    Projects segment efforts to the columns in SEGMENT_EFFORT_DTYPES, the
+    rest of the nested fields are never flattened
+    """
 
-    # check if rate limit is exceeded
-    check_rate_limit_exceeded(req)
+    efforts = list(efforts)
+    df = pd.DataFrame(
+        {
+            name: [_get_field(effort, name) for effort in efforts]
+            for name in SEGMENT_EFFORT_DTYPES
+        },
+        index=pd.RangeIndex(len(efforts)))
 
-    logger.info("Loading segments...done!")
+    df["start_date"] = pd.to_datetime(df["start_date"], utc=True)
+    df["segment.climb_category"] = df["segment.climb_category"].fillna(0)
 
-    return pd.json_normalize(req['segment_efforts'])
+    return df.astype(SEGMENT_EFFORT_DTYPES)
 
 
-def _get_sec(time_str):
-    """ Get Seconds from time """
+def _get_field(effort, name):
+    """ Gets a nested field such as "segment.city", None if missing """
 
-    if time_str.find("s") == -1:
-        try:
-            h, m, s = time_str.split(':')
-            return int(h) * 3600 + int(m) * 60 + int(s)
-        except ValueError:
-            m, s = time_str.split(':')
-            return int(m) * 60 + int(s)
-    else:
-        return [int(s) for s in re.findall(r'-?\d+\.?\d*', time_str)][0]
+    value = effort
+    for key in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
 
 
-def _get_time_from_leader(segment_id, gender, tokens):
+def _get_secs(time_strs):
     """
-    Gets the time of the segment's leader in seconds and calculates
-    the percent difference from the anthlete time
+    Gets seconds from a Series of times such as "1:02:03", "2:03" or
+    "45s". Times that can't be parsed are 0
     """
-    try:
-        # store URL for activities endpoint
-        base_url = "https://www.strava.com/api/v3/"
-        endpoint = "segments/{}".format(segment_id)
-        url = base_url + endpoint
 
-        # define headers and parameters for request
-        headers = {"Authorization": "Bearer {}".format(tokens["access_token"])}
+    time_strs = pd.Series(time_strs, dtype="object")
+    has_unit = time_strs.str.contains("s", regex=False, na=False)
+
+    # "h:m:s" or "m:s"
+    clock = time_strs.str.extract(r'^(?:(-?\d+):)?(-?\d+):(-?\d+)$').astype(
+        "float64")
+    clock_secs = clock[0].fillna(0) * 3600 + clock[1] * 60 + clock[2]
+
+    # "45s", decimal values are not valid
+    number = time_strs.str.extract(r'(-?\d+\.?\d*)', expand=False)
+    unit_secs = pd.to_numeric(number.where(~number.str.contains(
+        ".", regex=False, na=True)),
+                              errors="coerce")
 
+    secs = clock_secs.where(~has_unit, unit_secs)
+
+    return secs.fillna(0).astype("int64")
+
+
+def _get_xom_time(segment_id, gender, tokens):
+    """
+    Gets the KOM/QOM time of a segment as returned by the API (e.g. "5:23")
+    or None if it can't be retrieved
+    """
+    try:
         # make GET request to Strava API
-        req = requests.get(url, headers=headers).json()
+        req = get_client().get("segments/{}".format(segment_id),
+                               tokens,
+                               priority=PRIORITY_LOW)
 
         # check if rate limit is exceeded
         check_rate_limit_exceeded(req)
 
-        # get leader time
-        leader_elapsed_time = _get_sec(
-            req['xoms']['qom']) if gender == 'women' else _get_sec(
-                req['xoms']['kom'])
-
-        return leader_elapsed_time
+        return req['xoms']['qom'] if gender == 'women' else req['xoms']['kom']
 
+    except RateLimitExceeded:
+        # a ranking with missing leader times must not be cached
+        raise
     except Exception:
+        return None
+
+
+@timed("fetch.leader_times")
+def _get_leader_times(segment_ids, gender, tokens, max_workers=8):
+    """
+    Gets the leader time in seconds for several segments. The requests are
+    made concurrently with up to max_workers threads, max_workers=1 makes
+    them sequentially. The times are parsed in bulk and the ones that can't
+    be retrieved are 0. Returns a Series aligned with segment_ids
+    """
+    segment_ids = pd.Series(segment_ids)
+
+    start = time.perf_counter()
+
+    def fetch(segment_id):
+        return _get_xom_time(segment_id, gender=gender, tokens=tokens)
+
+    if max_workers is None or max_workers <= 1 or len(segment_ids) <= 1:
+        xom_times = [fetch(segment_id) for segment_id in segment_ids]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # the workers record their requests in the caller's trace
+            xom_times = list(executor.map(propagate(fetch), segment_ids))
+
+    leader_times = _get_secs(xom_times)
+    leader_times.index = segment_ids.index
+
+    for segment_id in segment_ids[leader_times == 0]:
         logger.info(f"Couldn't retrieve the leader elapsed time for the following segment: {segment_id}")  # noqa: E501
 
-        return 0
+    logger.info(
+        f"Retrieved {len(leader_times)} leader times in "
+        f"{time.perf_counter() - start:.2f}s (max_workers={max_workers}).")
+
+    return leader_times
+
+
+def _format_seconds(seconds):
+    """
+    Vectorized str(timedelta(seconds=x)), formats a Series of seconds
+    as "h:mm:ss", with a "n day(s), " prefix above 24 hours
+    """
+
+    seconds = pd.Series(seconds).astype("int64")
+
+    days, rem = np.divmod(seconds, 86400)
+    hours, rem = np.divmod(rem, 3600)
+    minutes, secs = np.divmod(rem, 60)
+
+    clock = (hours.astype(str) + ":" + minutes.astype(str).str.zfill(2) +
+             ":" + secs.astype(str).str.zfill(2))
+    prefix = days.astype(str) + np.where(days.abs() == 1, " day, ", " days, ")
+
+    return clock.where(days == 0, prefix + clock)
 
 
 def calculate_terrain(grade,
@@ -210,3 +339,23 @@ def calculate_terrain(grade,
         terrain = 'other'
 
     return terrain
+
+
+def calculate_terrains(grades,
+                       elv_diffs,
+                       grade_threshold=1,
+                       elv_diff_threshold=20):
+    """ Vectorized version of calculate_terrain """
+
+    grades = np.asarray(grades, dtype="float64")
+    elv_diffs = np.asarray(elv_diffs, dtype="float64")
+
+    conditions = [
+        (grades >= grade_threshold) & (elv_diffs >= elv_diff_threshold),
+        (grades <= -grade_threshold) & (elv_diffs <= elv_diff_threshold),
+        (-grade_threshold <= grades) & (grades <= grade_threshold) &
+        (-elv_diff_threshold <= elv_diffs) & (elv_diffs <= elv_diff_threshold)
+    ]
+
+    return np.select(conditions, ['uphill', 'downhill', 'flat'],
+                     default='other')
@@ -0,0 +1,379 @@
+""" HTTP service exposing the segments ranking without Streamlit
+
+Usage:
+    python -m pystrava.service [--host 0.0.0.0] [--port 8080]
+
+Endpoints, authenticated with an "Authorization: Bearer <access token>"
+header that is checked with Strava before any response is served:
+    GET /activities/{id}/segments?gender=men&filter=climbs&pr=3&format=json
+    GET /activities/{id}/map
+    GET /segments/{id}/coordinates?format=json
+    GET /segments/{id}/map
+    GET /health
+
+Tables are returned as JSON records, or in the format parameter: arrow
+(IPC stream), parquet or csv. Responses have an ETag and are compressed
+with gzip when the client accepts it.
+"""
+
+import io
+import os
+import re
+import gzip
+import time
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from pystrava.activities import get_activity, get_athlete
+from pystrava.batch import flatten_nested
+from pystrava.client import get_client
+from pystrava.maps import create_map, MAP_STYLES
+from pystrava.ratelimit import PRIORITY_HIGH, RateLimitExceeded
+from pystrava.segments import sort_segments_from_activity
+from pystrava.timing import trace
+from pystrava.transformations import get_activity_coordinates, get_segment_coordinates  # noqa: E501
+from pystrava.utils import check_rate_limit_exceeded
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "csv": "text/csv",
+}
+
+# accepted values of the query parameters
+QUERY_PARAMETERS = {
+    "gender": ["men", "women"],
+    "filter": ["climbs", "all"],
+    "pr": ["1", "2", "3"],
+    "format": list(CONTENT_TYPES),
+    "style": list(MAP_STYLES),
+}
+
+# responses smaller than this are not worth compressing
+MIN_GZIP_SIZE = 1024
+
+logger = logging.getLogger("pystrava")
+
+
+class ServiceError(Exception):
+    """ Error returned to the client with an HTTP status """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class AnalysisService:
+    """
+    Computes the responses of the endpoints and keeps the most recent ones
+    for ttl seconds, so repeated requests don't rank or render again. The
+    tokens are checked with Strava before any response is reused
+    """
+
+    # each endpoint returns (content type, body, whether the response can
+    # be shared by every athlete)
+    ROUTES = [
+        (re.compile(r"/activities/(\d+)/segments"), "ranked_segments"),
+        (re.compile(r"/activities/(\d+)/map"), "activity_map"),
+        (re.compile(r"/segments/(\d+)/coordinates"), "segment_coordinates"),
+        (re.compile(r"/segments/(\d+)/map"), "segment_map"),
+    ]
+
+    def __init__(self, ttl: int = 300, max_entries: int = 256):
+        """
+        :param ttl: seconds a response is reused
+        :param max_entries: number of responses kept
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._responses = OrderedDict()
+        # expiration of the validation of each token hash
+        self._validated = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, query: dict, tokens: dict):
+        """
+        :return: (content type, body, ETag) of the response of an endpoint
+        """
+
+        for pattern, name in self.ROUTES:
+            match = pattern.fullmatch(path)
+            if match:
+                break
+        else:
+            raise ServiceError(404, f"Unknown endpoint: {path}")
+
+        for param, value in query.items():
+            if value not in QUERY_PARAMETERS.get(param, [value]):
+                raise ServiceError(
+                    400, f"Invalid {param}: {value}, expected one of "
+                    f"{', '.join(QUERY_PARAMETERS[param])}")
+
+        token_hash = hashlib.sha256(
+            tokens["access_token"].encode()).hexdigest()[:16]
+        self._validate(tokens, token_hash)
+
+        # the responses of public segments are shared by every athlete,
+        # the rest may be private so they are per token
+        params = tuple(sorted(query.items()))
+        shared_key, private_key = (path, params, None), (path, params,
+                                                         token_hash)
+
+        with self._lock:
+            for key in [shared_key, private_key]:
+                cached = self._responses.get(key)
+                if cached is not None and cached[0] > time.time():
+                    self._responses.move_to_end(key)
+                    return cached[1:]
+
+        content_type, body, shared = getattr(self, name)(match.group(1),
+                                                         query, tokens)
+        # weak, since the body may be sent compressed or not
+        etag = 'W/"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+
+        key = shared_key if shared else private_key
+        with self._lock:
+            self._responses[key] = (time.time() + self.ttl, content_type,
+                                    body, etag)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_entries:
+                self._responses.popitem(last=False)
+
+        return content_type, body, etag
+
+    def _validate(self, tokens, token_hash):
+        """ Checks that Strava accepts a token, once every ttl seconds """
+
+        with self._lock:
+            if self._validated.get(token_hash, 0) > time.time():
+                self._validated.move_to_end(token_hash)
+                return
+
+        athlete = get_athlete(tokens)
+        if "message" in athlete:
+            raise ServiceError(401, athlete["message"])
+
+        with self._lock:
+            self._validated[token_hash] = time.time() + self.ttl
+            self._validated.move_to_end(token_hash)
+            while len(self._validated) > self.max_entries:
+                self._validated.popitem(last=False)
+
+    def ranked_segments(self, activity_id, query, tokens):
+        pr_filter = query.get("pr")
+        df_segments = sort_segments_from_activity(
+            tokens=tokens,
+            activity_id=activity_id,
+            gender=query.get("gender", "men"),
+            filter_type=query.get("filter", "climbs"),
+            pr_filter=int(pr_filter) if pr_filter else None,
+            activity=_get_activity(activity_id, tokens))
+
+        return (*_encode_table(df_segments, query.get("format", "json")),
+                False)
+
+    def activity_map(self, activity_id, query, tokens):
+        activity = _get_activity(activity_id, tokens)
+        df_coordinates = get_activity_coordinates(activity_id,
+                                                  tokens,
+                                                  activity=activity)
+        deck = create_map(df_coordinates, query.get("style", "dark"))
+
+        return CONTENT_TYPES["json"], deck.to_json().encode(), False
+
+    def segment_coordinates(self, segment_id, query, tokens):
+        segment = _get_segment(segment_id, tokens)
+        df_coordinates = get_segment_coordinates(segment_id,
+                                                 tokens,
+                                                 segment=segment)
+
+        return (*_encode_table(df_coordinates, query.get("format", "json")),
+                not segment.get("private"))
+
+    def segment_map(self, segment_id, query, tokens):
+        segment = _get_segment(segment_id, tokens)
+        df_coordinates = get_segment_coordinates(segment_id,
+                                                 tokens,
+                                                 segment=segment)
+        deck = create_map(df_coordinates, query.get("style", "outdoors"))
+
+        return (CONTENT_TYPES["json"], deck.to_json().encode(),
+                not segment.get("private"))
+
+
+def _get_activity(activity_id, tokens):
+    """ Gets an activity, raises ServiceError if Strava can't return it """
+
+    activity = get_activity(activity_id, tokens)
+    if "message" in activity:
+        raise _strava_error(activity)
+    return activity
+
+
+def _get_segment(segment_id, tokens):
+    """ Gets a segment, raises ServiceError if Strava can't return it """
+
+    segment = get_client().get("segments/{}".format(segment_id),
+                               tokens,
+                               priority=PRIORITY_HIGH)
+    check_rate_limit_exceeded(segment)
+    if "message" in segment:
+        raise _strava_error(segment)
+    return segment
+
+
+def _strava_error(response):
+    """ Error of a response of Strava, not found unless it's unauthorized """
+
+    status = 401 if response["message"] == "Authorization Error" else 404
+    return ServiceError(status, response["message"])
+
+
+def _encode_table(df, fmt):
+    """ Serializes a dataframe in one of CONTENT_TYPES """
+
+    if fmt not in CONTENT_TYPES:
+        raise ServiceError(400, f"Unknown format: {fmt}")
+
+    if fmt == "json":
+        body = df.to_json(orient="records", date_format="iso").encode()
+    elif fmt == "csv":
+        body = df.to_csv(index=False).encode()
+    elif fmt == "parquet":
+        buffer = io.BytesIO()
+        flatten_nested(df).to_parquet(buffer, index=False)
+        body = buffer.getvalue()
+    else:
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(flatten_nested(df),
+                                     preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        body = sink.getvalue().to_pybytes()
+
+    return CONTENT_TYPES[fmt], body
+
+
+def make_handler(service: AnalysisService):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        # send the body right after the headers instead of holding it
+        # back until the client acknowledges them
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/health":
+                return self._send(200, CONTENT_TYPES["json"], b'{"ok": true}')
+
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            authorization = self.headers.get("Authorization", "")
+            access_token = authorization[len("Bearer "):].strip() \
+                if authorization.startswith("Bearer ") else ""
+            if not access_token:
+                return self._send_error(401, "Missing bearer token",
+                                        {"WWW-Authenticate": "Bearer"})
+            tokens = {"access_token": access_token}
+
+            try:
+                with trace("service"):
+                    content_type, body, etag = service.get(
+                        url.path, query, tokens)
+            except ServiceError as e:
+                headers = {"WWW-Authenticate": "Bearer"} \
+                    if e.status == 401 else None
+                return self._send_error(e.status, str(e), headers)
+            except RateLimitExceeded as e:
+                return self._send_error(429, str(e), {"Retry-After": "900"})
+            except Exception as e:
+                logger.exception(e)
+                return self._send_error(500, "Internal error")
+
+            headers = {
+                "ETag": etag,
+                "Cache-Control": f"private, max-age={service.ttl}",
+                "Vary": "Accept-Encoding, Authorization"
+            }
+            if _etag_matches(self.headers.get("If-None-Match", ""), etag):
+                return self._send(304, None, b"", headers)
+
+            if len(body) >= MIN_GZIP_SIZE and "gzip" in self.headers.get(
+                    "Accept-Encoding", ""):
+                body = gzip.compress(body, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+
+            self._send(200, content_type, body, headers)
+
+        def _send_error(self, status, message, headers=None):
+            self._send(status, CONTENT_TYPES["json"],
+                       json.dumps({
+                           "message": message
+                       }).encode(), headers)
+
+        def _send(self, status, content_type, body, headers=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.info(format % args)
+
+    return Handler
+
+
+def _etag_matches(if_none_match, etag):
+    """ Weak comparison of the ETags of an If-None-Match header """
+
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag[2:] in [
+        tag[2:] if tag.startswith("W/") else tag for tag in tags
+    ]
+
+
+def make_server(host: str = "127.0.0.1",
+                port: int = 8080,
+                service: AnalysisService = None) -> ThreadingHTTPServer:
+    service = AnalysisService() if service is None else service
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(
+        description="HTTP service for the segments ranking")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port",
+                        type=int,
+                        default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--ttl",
+                        type=int,
+                        default=300,
+                        help="seconds a response is reused")
+    args = parser.parse_args(args)
+
+    server = make_server(args.host, args.port, AnalysisService(args.ttl))
+    logger.info(f"Serving on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+""" Spatial helpers and indexes for coordinates """
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from pystrava.client import get_client
+from pystrava.maps import _densify
+from pystrava.transformations import decode_polyline
+from pystrava.utils import DATA_DIR
+
+DEFAULT_SEGMENT_INDEX_PATH = os.path.join(DATA_DIR, "segment_index.npz")
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+# cell keys are row * _CELL_KEY_BASE + column, larger than any column
+_CELL_KEY_BASE = 2**32
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in km, vectorized over NumPy arrays """
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(
+        (lon2 - lon1) / 2)**2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class GridIndex:
+    """
+    Buckets points in a grid of square cells of cell_size_km degrees of
+    latitude, so the points near a location are found by looking only at
+    the cells around it
+    """
+
+    def __init__(self, cell_size_km: float = 0.5):
+        self.cell_size_km = cell_size_km
+        self.cell_size = cell_size_km / KM_PER_DEGREE
+        self.cells = {}
+
+    def _cells(self, lats, lons):
+        return (np.floor(np.asarray(lats) / self.cell_size).astype("int64"),
+                np.floor(np.asarray(lons) / self.cell_size).astype("int64"))
+
+    def insert(self, key, lat: float, lon: float):
+        rows, cols = self._cells([lat], [lon])
+        self.cells.setdefault((rows[0], cols[0]), []).append(key)
+
+    def query_cells(self, lats, lons, radius_km: float = 0) -> set:
+        """
+        Returns the keys of the points in the cells within radius_km of
+        any of the locations. It can include points farther than radius_km,
+        so the distances have to be checked by the caller
+        """
+
+        lats = np.atleast_1d(np.asarray(lats, dtype="float64"))
+        lons = np.atleast_1d(np.asarray(lons, dtype="float64"))
+        if len(lats) == 0:
+            return set()
+
+        rows, cols = self._cells(lats, lons)
+        # a degree of longitude gets shorter towards the poles
+        max_lat = min(np.abs(lats).max() + self.cell_size, 89.9)
+        n_rows = int(np.ceil(radius_km / self.cell_size_km))
+        n_cols = int(
+            np.ceil(radius_km /
+                    (self.cell_size_km * np.cos(np.radians(max_lat)))))
+
+        cells = np.unique(np.column_stack([rows, cols]), axis=0)
+
+        keys = set()
+        for row, col in cells:
+            for i in range(row - n_rows - 1, row + n_rows + 2):
+                for j in range(col - n_cols - 1, col + n_cols + 2):
+                    keys.update(self.cells.get((i, j), ()))
+
+        return keys
+
+    def query(self, lat: float, lon: float, radius_km: float) -> set:
+        """ Returns the keys of the points in the cells near a location """
+        return self.query_cells([lat], [lon], radius_km)
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.cells.values())
+
+
+class SegmentIndex:
+    """
+    Index of the start and end points and bounding boxes of known segments.
+    Segments are bucketed by the grid cell of their start and end points,
+    and the buckets are kept as sorted NumPy arrays so queries are a few
+    binary searches and the index can be saved and loaded without
+    rebuilding it point by point
+    """
+
+    def __init__(self, cell_size_km: float = 1):
+        self.cell_size_km = cell_size_km
+        self.cell_size = cell_size_km / KM_PER_DEGREE
+
+        self.ids = np.zeros(0, dtype="int64")
+        self.names = np.zeros(0, dtype="U")
+        self.starts = np.zeros((0, 2))
+        self.ends = np.zeros((0, 2))
+        # min latitude, min longitude, max latitude, max longitude
+        self.bboxes = np.zeros((0, 4))
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._build()
+
+    def __len__(self):
+        self._flush()
+        return len(self.ids)
+
+    def add_segment(self, segment_id, start, end, coordinates=None, name=""):
+        """
+        :param segment_id: id of the segment
+        :param start: (latitude, longitude) of the start point
+        :param end: (latitude, longitude) of the end point
+        :param coordinates: optional array of (latitude, longitude) rows of
+            the whole segment, used for its bounding box
+        :param name: name of the segment
+        """
+
+        points = np.asarray(
+            [start, end] if coordinates is None else coordinates,
+            dtype="float64").reshape(-1, 2)
+        bbox = np.concatenate([points.min(axis=0), points.max(axis=0)])
+
+        with self._lock:
+            self._pending[int(segment_id)] = (name or "", start, end, bbox)
+
+    def __contains__(self, segment_id) -> bool:
+        with self._lock:
+            return int(segment_id) in self._pending or bool(
+                np.isin(int(segment_id), self.ids))
+
+    def add_efforts(self, df_segments, cache=None) -> int:
+        """
+        Adds the segments of the efforts returned by the API that aren't in
+        the index yet and returns how many were added. The bounding boxes
+        come from the polylines of the segments in the response cache, or
+        from their start and end points if they aren't cached
+        """
+
+        cache = get_client().cache if cache is None else cache
+
+        self._flush()
+        df = df_segments.drop_duplicates("segment.id")
+        df = df[~np.isin(df["segment.id"].to_numpy(), self.ids)]
+
+        n_added = 0
+        for segment_id, name, start, end in zip(
+                df["segment.id"], df["segment.name"].fillna(""),
+                df["segment.start_latlng"], df["segment.end_latlng"]):
+            if isinstance(start, list) and isinstance(end, list) and len(
+                    start) == 2 and len(end) == 2:
+                self.add_segment(segment_id,
+                                 start,
+                                 end,
+                                 coordinates=_cached_coordinates(
+                                     cache, segment_id),
+                                 name=name)
+                n_added += 1
+
+        return n_added
+
+    def _flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+            new_ids = np.fromiter(pending, dtype="int64", count=len(pending))
+            keep = ~np.isin(self.ids, new_ids)
+            names, starts, ends, bboxes = zip(*pending.values())
+
+            self.ids = np.concatenate([self.ids[keep], new_ids])
+            self.names = np.concatenate([self.names[keep], np.array(names)])
+            self.starts = np.vstack([self.starts[keep], np.array(starts)])
+            self.ends = np.vstack([self.ends[keep], np.array(ends)])
+            self.bboxes = np.vstack([self.bboxes[keep], np.array(bboxes)])
+            self._build()
+
+    def _cell_keys(self, lats, lons):
+        rows = np.floor(np.asarray(lats) / self.cell_size).astype("int64")
+        cols = np.floor(np.asarray(lons) / self.cell_size).astype("int64")
+        return rows * _CELL_KEY_BASE + cols
+
+    def _build(self):
+        # the start and the end of each segment are bucketed
+        keys = np.concatenate([
+            self._cell_keys(self.starts[:, 0], self.starts[:, 1]),
+            self._cell_keys(self.ends[:, 0], self.ends[:, 1])
+        ])
+        rows = np.tile(np.arange(len(self.ids)), 2)
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._rows = rows[order]
+
+    def _candidates(self, lat, lon, radius_km):
+        """ Rows of the segments with a point in the cells around a point """
+
+        n_rows = int(np.ceil(radius_km / self.cell_size_km)) + 1
+        n_cols = int(
+            np.ceil(radius_km / (self.cell_size_km *
+                                 np.cos(np.radians(min(abs(lat), 89.9)))))) + 1
+        row, col = (int(np.floor(lat / self.cell_size)),
+                    int(np.floor(lon / self.cell_size)))
+
+        # cells of the same grid row have consecutive keys, so each row is
+        # a single range of the sorted keys
+        grid_rows = np.arange(row - n_rows, row + n_rows + 1)
+        lo = np.searchsorted(self._keys,
+                             grid_rows * _CELL_KEY_BASE + col - n_cols)
+        hi = np.searchsorted(self._keys,
+                             grid_rows * _CELL_KEY_BASE + col + n_cols,
+                             side="right")
+
+        if (hi - lo).sum() == 0:
+            return np.zeros(0, dtype="int64")
+
+        return np.unique(
+            np.concatenate([self._rows[a:b] for a, b in zip(lo, hi)]))
+
+    def _to_frame(self, rows, **columns):
+        return pd.DataFrame({
+            "segment.id": self.ids[rows],
+            "segment.name": self.names[rows],
+            "start_lat": self.starts[rows, 0],
+            "start_lng": self.starts[rows, 1],
+            "end_lat": self.ends[rows, 0],
+            "end_lng": self.ends[rows, 1],
+            **columns
+        })
+
+    def query_radius(self, lat: float, lon: float, radius_km: float):
+        """
+        Returns the segments that start or end within radius_km of a point,
+        or whose bounding box contains it, sorted by distance
+        """
+
+        self._flush()
+        bboxes = self.bboxes
+        inside = (bboxes[:, 0] <= lat) & (lat <= bboxes[:, 2]) & (
+            bboxes[:, 1] <= lon) & (lon <= bboxes[:, 3])
+        rows = np.union1d(self._candidates(lat, lon, radius_km),
+                          np.flatnonzero(inside))
+
+        distances = np.minimum(
+            haversine_km(lat, lon, self.starts[rows, 0], self.starts[rows, 1]),
+            haversine_km(lat, lon, self.ends[rows, 0], self.ends[rows, 1]))
+        distances = np.where(inside[rows], 0, distances)
+
+        found = distances <= radius_km
+        df = self._to_frame(rows[found], distance_km=distances[found])
+
+        return df.sort_values("distance_km", ignore_index=True)
+
+    def query_route(self, coordinates, buffer_km: float = 0.05):
+        """
+        Returns the segments crossed by a route, the ones whose start and
+        end points are within buffer_km of the route, start first
+        :param coordinates: array of (latitude, longitude) rows of the route
+        :param buffer_km: maximum distance from the route
+        """
+
+        self._flush()
+        route = np.asarray(coordinates, dtype="float64").reshape(-1, 2)
+
+        # fill the gaps of the route so every cell it crosses is checked
+        route = _densify(route, min(self.cell_size, buffer_km / KM_PER_DEGREE))
+
+        # segments starting in the cells of the route or their neighbours
+        route_keys = self._cell_keys(route[:, 0], route[:, 1])
+        neighbours = np.unique(
+            (route_keys[:, None] +
+             np.add.outer(np.arange(-1, 2) * _CELL_KEY_BASE, np.arange(
+                 -1, 2)).ravel()).ravel())
+        start_keys = self._cell_keys(self.starts[:, 0], self.starts[:, 1])
+        rows = np.flatnonzero(np.isin(start_keys, neighbours))
+
+        found, start_indexes = [], []
+        for row in rows:
+            to_start = haversine_km(route[:, 0], route[:, 1],
+                                    *self.starts[row])
+            to_end = haversine_km(route[:, 0], route[:, 1], *self.ends[row])
+            start_index, end_index = np.argmin(to_start), np.argmin(to_end)
+            if to_start[start_index] <= buffer_km and to_end[
+                    end_index] <= buffer_km and start_index <= end_index:
+                found.append(row)
+                start_indexes.append(start_index)
+
+        df = self._to_frame(np.array(found, dtype="int64"),
+                            route_index=np.array(start_indexes,
+                                                 dtype="int64"))
+
+        return df.sort_values("route_index", ignore_index=True)
+
+    def save(self, path: str = DEFAULT_SEGMENT_INDEX_PATH):
+        """ Saves the index to a .npz file """
+
+        self._flush()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path,
+                 cell_size_km=self.cell_size_km,
+                 ids=self.ids,
+                 names=self.names,
+                 starts=self.starts,
+                 ends=self.ends,
+                 bboxes=self.bboxes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_SEGMENT_INDEX_PATH):
+        """ Loads an index saved with save, empty if the file is missing """
+
+        if not os.path.exists(path):
+            return cls()
+
+        with np.load(path) as data:
+            index = cls(float(data["cell_size_km"]))
+            index.ids = data["ids"]
+            index.names = data["names"]
+            index.starts = data["starts"]
+            index.ends = data["ends"]
+            index.bboxes = data["bboxes"]
+
+        index._build()
+        return index
+
+
+def _cached_coordinates(cache, segment_id):
+    """ Coordinates of a segment in the response cache, None if missing """
+
+    if cache is None:
+        return None
+
+    segment = cache.get("segments/{}".format(int(segment_id)), "segments")
+    polyline = (segment or {}).get("map", {}).get("polyline")
+    coordinates = decode_polyline(polyline) if polyline else []
+
+    return coordinates if len(coordinates) else None
@@ -0,0 +1,193 @@
+""" Functions for retrieving and storing the streams of activities """
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pystrava.client import get_client
+from pystrava.ratelimit import PRIORITY_LOW
+from pystrava.utils import athlete_dir, check_rate_limit_exceeded, DATA_DIR
+
+DEFAULT_STREAMS_DIR = os.path.join(DATA_DIR, "streams")
+
+# one record per sample of the activity, missing values are NaN
+STREAM_DTYPE = np.dtype([
+    ("time", "int32"),
+    ("lat", "float64"),
+    ("lng", "float64"),
+    ("distance", "float64"),
+    ("altitude", "float32"),
+    ("watts", "float32"),
+    ("heartrate", "float32"),
+    ("cadence", "float32"),
+])
+
+STREAM_KEYS = [
+    "time", "latlng", "distance", "altitude", "watts", "heartrate", "cadence"
+]
+
+logger = logging.getLogger("pystrava")
+
+
+def streams_dir(athlete_id) -> str:
+    """ Directory of the StreamStore of an athlete """
+    return os.path.join(athlete_dir(athlete_id), "streams")
+
+
+def get_activity_streams(activity_id, tokens) -> np.ndarray:
+    """
+    Gets the streams of an activity as a record array with STREAM_DTYPE
+    """
+
+    # make GET request to Strava API
+    req = get_client().get("activities/{}/streams".format(activity_id),
+                           tokens,
+                           params={
+                               "keys": ",".join(STREAM_KEYS),
+                               "key_by_type": "true"
+                           },
+                           priority=PRIORITY_LOW)
+
+    # check if rate limit is exceeded
+    check_rate_limit_exceeded(req)
+
+    return streams_to_records(req)
+
+
+def streams_to_records(req: dict) -> np.ndarray:
+    """ Converts the streams returned by the API to a STREAM_DTYPE array """
+
+    if "message" in req:
+        raise ValueError("Couldn't retrieve the streams: {}".format(
+            req["message"]))
+
+    n_samples = max([len(stream["data"]) for stream in req.values()] or [0])
+    records = np.zeros(n_samples, dtype=STREAM_DTYPE)
+    for key in STREAM_DTYPE.names[1:]:
+        records[key] = np.nan
+    records["time"] = np.arange(n_samples)
+
+    for key, stream in req.items():
+        data = np.asarray(stream["data"], dtype="float64")
+        if len(data) != n_samples:
+            continue
+        if key == "latlng":
+            # an empty stream is 1-dimensional
+            data = data.reshape(-1, 2)
+            records["lat"] = data[:, 0]
+            records["lng"] = data[:, 1]
+        elif key in STREAM_DTYPE.names:
+            records[key] = data
+
+    return records
+
+
+class StreamStore:
+    """
+    Stores the streams of each activity in its own .npy file, which is
+    opened memory-mapped so only the samples that are read are loaded
+    """
+
+    def __init__(self, root: str = DEFAULT_STREAMS_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, activity_id):
+        return os.path.join(self.root, "{}.npy".format(int(activity_id)))
+
+    def __contains__(self, activity_id) -> bool:
+        return os.path.exists(self._path(activity_id))
+
+    def activity_ids(self) -> list:
+        return sorted(
+            int(f[:-4]) for f in os.listdir(self.root) if f.endswith(".npy"))
+
+    def save(self, activity_id, records: np.ndarray):
+        # write to a temporary file first so readers never see a partial file
+        tmp_path = self._path(activity_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(records, dtype=STREAM_DTYPE))
+        os.replace(tmp_path, self._path(activity_id))
+
+    def load(self, activity_id) -> np.ndarray:
+        """ Opens the streams of an activity as a read-only memory map """
+        return np.load(self._path(activity_id), mmap_mode="r")
+
+    def fetch(self, activity_id, tokens) -> np.ndarray:
+        """ Loads the streams of an activity, fetching them if missing """
+
+        if activity_id not in self:
+            self.save(activity_id, get_activity_streams(activity_id, tokens))
+
+        return self.load(activity_id)
+
+    def sync(self, activity_ids, tokens) -> list:
+        """
+        Fetches the streams of the activities that aren't stored yet and
+        returns the ids of the ones that were fetched
+        """
+
+        fetched = []
+        for activity_id in activity_ids:
+            if activity_id in self:
+                continue
+            try:
+                self.save(activity_id,
+                          get_activity_streams(activity_id, tokens))
+                fetched.append(activity_id)
+            except ValueError as e:
+                logger.info(f"{e} (activity {activity_id})")
+
+        logger.info(f"Fetched the streams of {len(fetched)} activities.")
+
+        return fetched
+
+
+def effort_stream_metrics(records: np.ndarray, start_index: int,
+                          end_index: int) -> dict:
+    """
+    Summarizes the samples of a segment effort, start_index and end_index
+    are the ones of the segment efforts returned by the API
+    """
+
+    effort = records[int(start_index):int(end_index) + 1]
+
+    # samples are weighted by their duration, as devices don't always
+    # record once per second
+    durations = np.diff(effort["time"], append=effort["time"][-1:]).astype(
+        "float64") if len(effort) else np.array([])
+
+    metrics = {}
+    for key in ["watts", "heartrate", "cadence"]:
+        values = effort[key].astype("float64")
+        valid = ~np.isnan(values)
+        if not valid.any():
+            metrics[f"stream_average_{key}"] = np.nan
+            metrics[f"stream_max_{key}"] = np.nan
+            continue
+        weights = durations[valid]
+        metrics[f"stream_average_{key}"] = np.average(
+            values[valid], weights=weights) if weights.sum() > 0 else np.mean(
+                values[valid])
+        metrics[f"stream_max_{key}"] = values[valid].max()
+
+    return metrics
+
+
+def add_stream_metrics(df_segments: pd.DataFrame,
+                       records: np.ndarray) -> pd.DataFrame:
+    """
+    Adds the per-second metrics of each effort (average and maximum power,
+    heart rate and cadence) computed from the streams of the activity
+    """
+
+    metrics = pd.DataFrame(
+        [
+            effort_stream_metrics(records, start, end) for start, end in zip(
+                df_segments["start_index"], df_segments["end_index"])
+        ],
+        index=df_segments.index)
+
+    return df_segments.assign(**metrics)
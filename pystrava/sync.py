@@ -0,0 +1,156 @@
+""" Functions for keeping a local copy of the athlete's activities """
+
+import os
+import logging
+
+import pandas as pd
+
+from pystrava.client import get_client
+from pystrava.utils import check_rate_limit_exceeded, DATA_DIR
+
+DEFAULT_ACTIVITIES_PATH = os.path.join(DATA_DIR, "activities.parquet")
+
+# columns kept from the activity summaries and their types
+ACTIVITY_DTYPES = {
+    "id": "int64",
+    "name": "string",
+    "type": "category",
+    "start_date": "datetime64[ns, UTC]",
+    "start_date_local": "datetime64[ns]",
+    "distance": "float64",
+    "moving_time": "int32",
+    "elapsed_time": "int32",
+    "total_elevation_gain": "float32",
+    "average_speed": "float32",
+    "average_watts": "float32",
+    "start_lat": "float64",
+    "start_lng": "float64",
+    "end_lat": "float64",
+    "end_lng": "float64",
+    "summary_polyline": "string",
+    "external_id": "string",
+}
+
+logger = logging.getLogger("pystrava")
+
+
+def iter_activities(tokens, after=None, per_page=200):
+    """
+    Generator over the summaries of the athlete's activities, requesting
+    one page at a time from /athlete/activities
+    :param tokens: Strava tokens
+    :param after: only activities that started after this epoch timestamp
+    :param per_page: number of activities per request, 200 at most
+    """
+
+    page = 1
+    while True:
+        params = {"page": page, "per_page": per_page}
+        if after is not None:
+            params["after"] = int(after)
+
+        # make GET request to Strava API
+        req = get_client().get("athlete/activities", tokens, params=params)
+
+        # check if rate limit is exceeded
+        check_rate_limit_exceeded(req)
+        if not isinstance(req, list):
+            raise RuntimeError("Couldn't retrieve the activities: {}".format(
+                req.get("message")))
+
+        if not req:
+            return
+
+        yield from req
+        page += 1
+
+
+def activities_to_frame(activities) -> pd.DataFrame:
+    """ Projects activity summaries to the columns in ACTIVITY_DTYPES """
+
+    df = pd.json_normalize(list(activities))
+
+    columns = {}
+    for name, latlng in [("start", "start_latlng"), ("end", "end_latlng")]:
+        if latlng in df:
+            points = df[latlng]
+        else:
+            points = pd.Series(index=df.index, dtype="object")
+        points = points.apply(lambda p: p if isinstance(p, list) and len(
+            p) == 2 else [None, None])
+        columns[name + "_lat"] = points.str[0]
+        columns[name + "_lng"] = points.str[1]
+
+    if "map.summary_polyline" in df:
+        columns["summary_polyline"] = df["map.summary_polyline"]
+
+    df = df.assign(**columns)
+    for name in ACTIVITY_DTYPES:
+        if name not in df:
+            df[name] = None
+
+    df = df[list(ACTIVITY_DTYPES)]
+    df["start_date"] = pd.to_datetime(df["start_date"], utc=True)
+    # the local start date is returned with a misleading "Z" suffix
+    df["start_date_local"] = pd.to_datetime(
+        df["start_date_local"]).dt.tz_localize(None)
+
+    return df.astype(ACTIVITY_DTYPES)
+
+
+def load_activities(path: str = DEFAULT_ACTIVITIES_PATH) -> pd.DataFrame:
+    """ Loads the local copy of the activities, empty if there isn't one """
+
+    if not os.path.exists(path):
+        return activities_to_frame([])
+
+    return pd.read_parquet(path).astype(ACTIVITY_DTYPES)
+
+
+def sync_activities(tokens,
+                    path: str = DEFAULT_ACTIVITIES_PATH,
+                    per_page: int = 200) -> pd.DataFrame:
+    """
+    Updates the local copy of the activities stored in path. The first sync
+    pages through the whole history, the next ones only request the
+    activities that started after the last one stored
+    """
+
+    df_activities = load_activities(path)
+
+    after = None
+    if not df_activities.empty:
+        after = df_activities["start_date"].max().timestamp()
+
+    logger.info("Syncing activities...")
+
+    # convert the summaries page by page, so only one page of raw
+    # JSON is held in memory at a time
+    pages, page = [], []
+    for activity in iter_activities(tokens, after=after, per_page=per_page):
+        page.append(activity)
+        if len(page) == per_page:
+            pages.append(activities_to_frame(page))
+            page = []
+    pages.append(activities_to_frame(page))
+
+    df_new = pd.concat(pages, ignore_index=True)
+    logger.info(f"Syncing activities...done! {df_new.shape[0]} new "
+                "activities.")
+
+    if df_new.empty:
+        return df_activities
+
+    df_activities = pd.concat([df_activities, df_new], ignore_index=True)
+    df_activities = df_activities.drop_duplicates(
+        "id", keep="last").sort_values(
+            "start_date", ascending=False).reset_index(drop=True)
+    df_activities = df_activities.astype(ACTIVITY_DTYPES)
+
+    # write to a temporary file first so readers never see a partial file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    df_activities.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    return df_activities
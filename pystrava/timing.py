@@ -0,0 +1,208 @@
+""" Timing instrumentation of the fetch, parse, rank and render stages """
+
+import time
+import bisect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# upper bounds in seconds of the buckets of the histograms, from 1ms to ~65s
+BUCKETS = [0.001 * 2**i for i in range(17)]
+
+logger = logging.getLogger("pystrava")
+
+_trace = contextvars.ContextVar("pystrava_trace", default=None)
+_stage = contextvars.ContextVar("pystrava_stage", default=None)
+
+
+class Histogram:
+    """ Distribution of the durations of a stage in BUCKETS """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, duration: float):
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, q: float) -> float:
+        """ Upper bound of the bucket that contains the q quantile """
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [self.max], self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "p50_s": self.percentile(0.5),
+            "p95_s": self.percentile(0.95),
+            "max_s": self.max
+        }
+
+
+class Metrics:
+    """
+    Counters and duration histograms aggregated over every trace of the
+    process, e.g. every rerun of every Streamlit session
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def observe(self, stage: str, duration: float):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(duration)
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stats(self) -> dict:
+        """
+        :return: {"counters": {name: value}, "stages": {stage: summary}}
+        """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {
+                    stage: histogram.summary()
+                    for stage, histogram in sorted(self.histograms.items())
+                }
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+METRICS = Metrics()
+
+
+class Trace:
+    """
+    Spans and counters of a single request, e.g. a page render. Spans
+    recorded by worker threads started with propagate are added too
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, parent, start, duration):
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "parent": parent,
+                "start_s": start - self.start,
+                "duration_s": duration
+            })
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> list:
+        """ Number of calls and total time of each stage of the trace """
+
+        stages = {}
+        with self._lock:
+            for span in self.spans:
+                stage = stages.setdefault(span["stage"], {
+                    "stage": span["stage"],
+                    "calls": 0,
+                    "total_s": 0.0
+                })
+                stage["calls"] += 1
+                stage["total_s"] += span["duration_s"]
+
+        return sorted(stages.values(), key=lambda s: -s["total_s"])
+
+
+@contextmanager
+def trace(name: str):
+    """
+    Collects the spans and counters recorded until the block exits, can be
+    used as a decorator too
+    """
+
+    current = Trace(name)
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _trace.reset(token)
+        METRICS.observe(f"trace.{name}", current.duration)
+        logger.info(f"{name} took {current.duration:.2f}s "
+                    f"({len(current.spans)} spans, {current.counters}).")
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Records the duration of a block in the histogram of the stage and in
+    the current trace, can be used as a decorator too
+    """
+
+    parent = _stage.get()
+    token = _stage.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _stage.reset(token)
+        METRICS.observe(stage, duration)
+        current = _trace.get()
+        if current is not None:
+            current.add_span(stage, parent, start, duration)
+
+
+def increment(name: str, value: int = 1):
+    """ Increments a counter of the process and of the current trace """
+
+    METRICS.increment(name, value)
+    current = _trace.get()
+    if current is not None:
+        current.increment(name, value)
+
+
+def current_trace():
+    return _trace.get()
+
+
+def propagate(fn):
+    """
+    Wraps fn so it runs with the trace and stage of the caller, e.g. when
+    it's submitted to a ThreadPoolExecutor
+    """
+
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # a context can't be entered by several threads at once
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
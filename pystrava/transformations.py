@@ -1,61 +1,124 @@
 """ Functions for working with coordinates """
 
-import requests
 import logging
 
+import numpy as np
 import pandas as pd
-import polyline
 
+from pystrava.activities import get_activity
+from pystrava.client import get_client
+from pystrava.ratelimit import PRIORITY_HIGH
 from pystrava.utils import check_rate_limit_exceeded
 
 logger = logging.getLogger("pystrava")
 
 
-def get_activity_coordinates(activity_id, tokens):
+def get_activity_coordinates(activity_id, tokens, activity=None):
 
-    # store URL for activities endpoint
-    base_url = "https://www.strava.com/api/v3/"
-    endpoint = "activities/{}".format(activity_id)
-    url = base_url + endpoint
-
-    # define headers and parameters for request
-    headers = {"Authorization": "Bearer {}".format(tokens["access_token"])}
-
-    # make GET request to Strava API
-    req = requests.get(url, headers=headers).json()
-
-    # check if rate limit is exceeded
-    check_rate_limit_exceeded(req)
+    # reuse the activity if it has already been fetched
+    req = get_activity(activity_id, tokens) if activity is None else activity
 
     # activity polyline
     activity_polyline = req['map']["polyline"]
 
-    # coordinates = polyline.decode(activity_polyline)
-    coordinates = polyline.decode(activity_polyline)
+    coordinates = decode_polyline(activity_polyline)
 
     return pd.DataFrame(coordinates, columns=["latitude", "longitude"])
 
 
-def get_segment_coordinates(segment_id, tokens):
-
-    # store URL for activities endpoint
-    base_url = "https://www.strava.com/api/v3/"
-    endpoint = "segments/{}".format(segment_id)
-    url = base_url + endpoint
+def get_segment_coordinates(segment_id,
+                            tokens,
+                            priority=PRIORITY_HIGH,
+                            segment=None):
 
-    # define headers and parameters for request
-    headers = {"Authorization": "Bearer {}".format(tokens["access_token"])}
+    if segment is None:
+        # make GET request to Strava API
+        req = get_client().get("segments/{}".format(segment_id),
+                               tokens,
+                               priority=priority)
 
-    # make GET request to Strava API
-    req = requests.get(url, headers=headers).json()
-
-    # check if rate limit is exceeded
-    check_rate_limit_exceeded(req)
+        # check if rate limit is exceeded
+        check_rate_limit_exceeded(req)
+    else:
+        # reuse the segment if it has already been fetched
+        req = segment
 
     # segment polyline
     segment_polyline = req['map']["polyline"]
 
-    # coordinates = polyline.decode(activity_polyline)
-    coordinates = polyline.decode(segment_polyline)
+    coordinates = decode_polyline(segment_polyline)
 
     return pd.DataFrame(coordinates, columns=["latitude", "longitude"])
+
+
+def decode_activities_polylines(polylines):
+    """
+    Decodes the polylines of many activities, e.g. the summary_polyline
+    column of pystrava.sync.load_activities(), into arrays of (latitude,
+    longitude) rows that can be passed to maps.create_heatmap
+    """
+
+    return decode_polylines([p for p in polylines if isinstance(p, str) and p])
+
+
+def decode_polyline(expression: str, precision: int = 5) -> np.ndarray:
+    """
+    Decodes a polyline into an array of (latitude, longitude) rows, with
+    the same values as polyline.decode
+    """
+    return decode_polylines([expression], precision)[0]
+
+
+def decode_polylines(expressions, precision: int = 5) -> list:
+    """
+    Decodes many polylines at once with NumPy, instead of reading them one
+    character at a time like polyline.decode
+    :param expressions: list of encoded polylines
+    :param precision: number of decimals of the encoded coordinates
+    :return: list with an array of (latitude, longitude) rows per polyline
+    """
+
+    if len(expressions) == 0:
+        return []
+
+    lengths = np.array([len(e) for e in expressions], dtype="int64")
+    data = np.frombuffer("".join(expressions).encode("ascii"),
+                         dtype=np.uint8).astype("int64") - 63
+
+    # each value is split in chunks of 5 bits, the 6th bit is set in
+    # every chunk except the last one of the value
+    is_last = (data & 0x20) == 0
+    polyline_ends = np.cumsum(lengths)
+    if not is_last[polyline_ends[lengths > 0] - 1].all():
+        raise ValueError("The polyline is truncated")
+
+    value_ends = np.flatnonzero(is_last)
+    value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+    value_index = np.cumsum(is_last) - is_last
+    shifts = 5 * (np.arange(len(data)) - value_starts[value_index])
+    values = np.add.reduceat((data & 0x1f) << shifts,
+                             value_starts) if len(data) else data
+
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    # number of values in each polyline, empty ones have none
+    n_values = np.bincount(np.searchsorted(polyline_ends,
+                                           value_ends,
+                                           side="right"),
+                           minlength=len(lengths))
+    if np.any(n_values % 2):
+        raise ValueError("The polyline has an odd number of values")
+
+    # coordinates are encoded as differences from the previous point,
+    # the running sums are restarted at the beginning of every polyline
+    n_points = n_values // 2
+    positions = np.cumsum(deltas.reshape(-1, 2), axis=0)
+    first_points = np.cumsum(n_points) - n_points
+    offsets = np.zeros((len(n_points), 2), dtype="int64")
+    has_points = (n_points > 0) & (first_points > 0)
+    offsets[has_points] = positions[first_points[has_points] - 1]
+    positions = positions - np.repeat(offsets, n_points, axis=0)
+
+    coordinates = positions / float(10**precision)
+
+    return np.split(coordinates, np.cumsum(n_points)[:-1])
@@ -1,28 +1,42 @@
 """ Helper functions for module """
 
 import os
-import requests
 import time
-import sys
 import logging
+import threading
+
+from pystrava.client import get_client
+from pystrava.ratelimit import RateLimitExceeded
 
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
+# directory where the local copies of the athlete's data are stored
+DATA_DIR = os.getenv("PYSTRAVA_DATA_DIR",
+                     os.path.join(os.path.expanduser("~"), ".pystrava"))
+
 logger = logging.getLogger("pystrava")
 
 
+def athlete_dir(athlete_id) -> str:
+    """
+    Directory of the local copies of an athlete's data, so the data of the
+    athletes sharing a deployment are never mixed
+    """
+    return os.path.join(DATA_DIR, "athletes", str(int(athlete_id)))
+
+
 def get_first_time_token(CODE):
     """ Gets the Strava tokens for the first time """
 
     # Make Strava auth API call with URL code from OAuth Authorization page
-    response = requests.post(url='https://www.strava.com/oauth/token',
-                             data={
-                                 'client_id': int(CLIENT_ID),
-                                 'client_secret': CLIENT_SECRET,
-                                 'grant_type': 'authorization_code',
-                                 'code': CODE
-                             }).json()
+    response = get_client().post_token(
+        data={
+            'client_id': int(CLIENT_ID),
+            'client_secret': CLIENT_SECRET,
+            'grant_type': 'authorization_code',
+            'code': CODE
+        })
 
     return {
         k: response[k]
@@ -31,21 +45,24 @@ def get_first_time_token(CODE):
     }
 
 
-def refresh_access_token_if_expired(tokens):
-    """ Refreshes strava tokens if time expired """
+def refresh_access_token_if_expired(tokens, margin=0):
+    """
+    Refreshes strava tokens if time expired, or if they expire within
+    margin seconds
+    """
 
     # If access_token has expired then use the refresh_token to get
     # the new access_token
-    if int(tokens['expires_at']) < time.time():
+    if int(tokens['expires_at']) < time.time() + margin:
 
         # Make Strava auth API call with current refresh token
-        response = requests.post(url='https://www.strava.com/oauth/token',
-                                 data={
-                                     'client_id': int(CLIENT_ID),
-                                     'client_secret': CLIENT_SECRET,
-                                     'grant_type': 'refresh_token',
-                                     'refresh_token': tokens['refresh_token']
-                                 })
+        response = get_client().post_token(
+            data={
+                'client_id': int(CLIENT_ID),
+                'client_secret': CLIENT_SECRET,
+                'grant_type': 'refresh_token',
+                'refresh_token': tokens['refresh_token']
+            })
 
         new_tokens = {
             k: response[k]
@@ -58,13 +75,160 @@ def refresh_access_token_if_expired(tokens):
         return tokens
 
 
+class TokenManager:
+    """
+    Keeps the tokens of several athletes, e.g. one per Streamlit session,
+    and refreshes them in a background thread refresh_margin seconds before
+    they expire, so no request has to wait for an OAuth round trip. The
+    tokens that haven't been used for idle_ttl seconds are dropped instead
+    """
+
+    def __init__(self,
+                 refresh_margin: int = 600,
+                 retry_interval: int = 60,
+                 idle_ttl: int = 86400):
+        """
+        :param refresh_margin: seconds before expires_at to refresh tokens
+        :param retry_interval: seconds to wait after a failed refresh
+        :param idle_ttl: seconds since the last use to drop tokens
+        """
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.idle_ttl = idle_ttl
+        self._tokens = {}
+        self._retry_at = {}
+        self._last_used = {}
+        self._condition = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def __contains__(self, key) -> bool:
+        with self._condition:
+            return key in self._tokens
+
+    def add(self, key, tokens: dict):
+        """ Stores the tokens of an athlete under key """
+
+        with self._condition:
+            self._tokens[key] = dict(tokens)
+            self._retry_at.pop(key, None)
+            self._last_used[key] = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="pystrava-tokens",
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def remove(self, key):
+        with self._condition:
+            self._tokens.pop(key, None)
+            self._retry_at.pop(key, None)
+            self._last_used.pop(key, None)
+
+    def exchange_code(self, code, key=None) -> dict:
+        """
+        Gets the tokens of an authorization code and stores them under key,
+        the code itself by default
+        """
+
+        tokens = get_first_time_token(code)
+        if "access_token" not in tokens:
+            raise RuntimeError("Couldn't get the Strava tokens")
+
+        self.add(code if key is None else key, tokens)
+
+        return tokens
+
+    def get(self, key) -> dict:
+        """ Returns valid tokens, raises KeyError for unknown keys """
+
+        with self._condition:
+            tokens = self._tokens[key]
+            self._last_used[key] = time.time()
+
+        # only if the background refresh failed until the expiration
+        if int(tokens["expires_at"]) < time.time():
+            tokens = self._refresh(key, margin=0)
+
+        return dict(tokens)
+
+    def _refresh(self, key, margin):
+
+        with self._refresh_lock:
+            with self._condition:
+                tokens = self._tokens.get(key)
+            if tokens is None:
+                raise KeyError(key)
+
+            # tokens refreshed meanwhile are returned as they are
+            new_tokens = refresh_access_token_if_expired(tokens, margin)
+            if "access_token" not in new_tokens:
+                raise RuntimeError("Couldn't refresh the Strava tokens")
+
+            with self._condition:
+                if key in self._tokens:
+                    self._tokens[key] = new_tokens
+
+        return new_tokens
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                now = time.time()
+                idle = [
+                    key for key, used in self._last_used.items()
+                    if now - used > self.idle_ttl
+                ]
+                for key in idle:
+                    self.remove(key)
+                if idle:
+                    logger.info(f"Dropped the tokens of {len(idle)} idle "
+                                "sessions")
+
+                due = {
+                    key: max(
+                        int(tokens["expires_at"]) - self.refresh_margin,
+                        self._retry_at.get(key, 0))
+                    for key, tokens in self._tokens.items()
+                }
+                ready = [key for key, at in due.items() if at <= now]
+                if not ready:
+                    # wake up for the next refresh or idle expiration
+                    wake_at = list(due.values()) + [
+                        used + self.idle_ttl
+                        for used in self._last_used.values()
+                    ]
+                    self._condition.wait(
+                        min(wake_at) - now if wake_at else None)
+                    continue
+
+            for key in ready:
+                try:
+                    self._refresh(key, margin=self.refresh_margin)
+                    logger.info("Refreshed the tokens in the background")
+                except KeyError:
+                    continue
+                except Exception as e:
+                    logger.info(f"Couldn't refresh the tokens: {e}")
+
+                # failed refreshes, or tokens that are still about to
+                # expire, are retried later
+                with self._condition:
+                    if key in self._tokens:
+                        self._retry_at[key] = time.time() + \
+                            self.retry_interval
+
+
 def check_rate_limit_exceeded(req):
+    """ Raises RateLimitExceeded if the response is a rate limit error """
 
     if "message" in req:
         logger.info(req['message'])
 
         if req['message'] == "Rate Limit Exceeded":
-            sys.exit("Reached the Strava requests limit, stopping execution")
+            raise RateLimitExceeded("Reached the Strava requests limit")
 
 
 def set_logger(name: str = "pystrava") -> logging.Logger:
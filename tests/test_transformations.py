@@ -0,0 +1,39 @@
+import numpy as np
+import polyline
+import pytest
+
+from pystrava.transformations import decode_polyline, decode_polylines
+
+TRACK = polyline.encode([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)])
+SHORT = polyline.encode([(52.35, 4.9)])
+
+
+@pytest.mark.parametrize("expressions", [
+    [TRACK],
+    [TRACK, SHORT, TRACK],
+    [""],
+    ["", TRACK],
+    ["", "", SHORT],
+    [TRACK, "", SHORT],
+    [TRACK, ""],
+])
+def test_decode_polylines_matches_polyline(expressions):
+    decoded = decode_polylines(expressions)
+
+    assert len(decoded) == len(expressions)
+    for expression, coordinates in zip(expressions, decoded):
+        expected = np.array(polyline.decode(expression)).reshape(-1, 2)
+        np.testing.assert_allclose(coordinates, expected)
+
+
+def test_decode_polylines_empty_list():
+    assert decode_polylines([]) == []
+
+
+def test_decode_polyline_truncated():
+    with pytest.raises(ValueError):
+        decode_polylines([TRACK[:-1] + "_", SHORT])
+
+
+def test_decode_polyline_empty():
+    assert decode_polyline("").shape == (0, 2)